@@ -0,0 +1,118 @@
+import base64
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flood_model.settings import *
+try:
+    from flood_model.secrets import *
+except ImportError:
+    print('No secrets file found.')
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ApiClient:
+
+    """
+    Client of the IBF API, shared by all DatabaseManagers of a process per API url and login.
+    It keeps one session with a pool of keep-alive connections, and the token of the login
+    until shortly (API_TOKEN_REFRESH_MARGIN) before it expires.
+    """
+
+    clients = {}
+    clientsLock = threading.Lock()
+
+    @classmethod
+    def get(cls, apiServiceUrl, password):
+        key = (apiServiceUrl, ADMIN_LOGIN, password)
+        with cls.clientsLock:
+            if key not in cls.clients:
+                cls.clients[key] = cls(apiServiceUrl, password)
+            return cls.clients[key]
+
+    def __init__(self, apiServiceUrl, password):
+        self.API_SERVICE_URL = apiServiceUrl
+        self.ADMIN_PASSWORD = password
+        self.session = requests.Session()
+        retry = Retry(connect=3, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=API_POOL_SIZE, pool_maxsize=API_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.token = None
+        self.tokenExpiry = 0
+        self.tokenLock = threading.Lock()
+        # the client is used from the upload threads
+        self.countLock = threading.Lock()
+        self.logins = 0
+        self.requests = 0
+
+    def authenticate(self, renew=False):
+        """
+        Token of the login, logging in again if there is none, it (almost) expired or renew is set.
+        Raises a requests HTTPError if the login fails.
+        """
+        with self.tokenLock:
+            if renew or self.token is None or time.time() > self.tokenExpiry - API_TOKEN_REFRESH_MARGIN:
+                login_response = self.session.post(self.API_SERVICE_URL + 'user/login', data=[(
+                    'email', ADMIN_LOGIN), ('password', self.ADMIN_PASSWORD)])
+                with self.countLock:
+                    self.logins += 1
+                try:
+                    login_response.raise_for_status()
+                    self.token = login_response.json()['user']['token']
+                except (ValueError, KeyError, TypeError) as e:
+                    raise requests.exceptions.HTTPError(f'Login failed: no token in the response ({e})',
+                                                        response=login_response)
+                self.tokenExpiry = self.tokenExpiration(self.token)
+            return self.token
+
+    @staticmethod
+    def tokenExpiration(token):
+        """Expiry (exp claim) of a JWT, or 0 if it can not be read, so the token is used once"""
+        try:
+            payload = token.split('.')[1]
+            return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return 0
+
+    def request(self, method, path, headers=None, **kwargs):
+        """
+        Request with the token of the login. If the API no longer accepts the token (401), the
+        request is sent once more with a new one.
+        """
+        for renew in [False, True]:
+            token = self.authenticate(renew)
+            with self.countLock:
+                self.requests += 1
+            response = self.session.request(method, self.API_SERVICE_URL + path,
+                                            headers={'Authorization': 'Bearer ' + token, **(headers or {})}, **kwargs)
+            if response.status_code != 401:
+                break
+            # rewind files and streamed bodies to send them again
+            for file in list((kwargs.get('files') or {}).values()) + [kwargs.get('data')]:
+                file = file[1] if isinstance(file, tuple) else file
+                if hasattr(file, 'seek'):
+                    file.seek(0)
+        return response
+
+    def connections(self):
+        """Connections opened by the session"""
+        connections = 0
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            connections += sum(pools[key].num_connections for key in pools.keys())
+        return connections
+
+    def metrics(self):
+        return {'logins': self.logins, 'requests': self.requests, 'connections': self.connections()}
+
+    @classmethod
+    def logStats(cls):
+        """Log the logins, requests and connections per API client"""
+        for client in list(cls.clients.values()):
+            metrics = client.metrics()
+            logger.info(f"API {client.API_SERVICE_URL}: {metrics['requests']} requests, "
+                        f"{metrics['logins']} logins, {metrics['connections']} connections")
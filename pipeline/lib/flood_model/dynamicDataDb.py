@@ -7,12 +7,18 @@ try:
 except ImportError:
     print('No secrets file found.')
 import os
+import time
+import tempfile
 import numpy as np
+import rasterio.shutil
 import logging
 logger = logging.getLogger(__name__)
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry 
+from flood_model.apiClient import ApiClient
+from flood_model.resultBus import ResultBus
+from flood_model.multipartStream import MultipartStream
+from flood_model.uploadSpool import UploadSpool
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
  
 
     
@@ -30,13 +36,19 @@ class DatabaseManager:
             self.EXPOSURE_DATA_UBR_SOURCES = SETTINGS[countryCodeISO3]['EXPOSURE_DATA_UBR_SOURCES']
         self.API_SERVICE_URL = SETTINGS[countryCodeISO3]['IBF_API_URL']
         self.ADMIN_PASSWORD = SETTINGS[countryCodeISO3]['PASSWORD']
+        self.api = ApiClient.get(self.API_SERVICE_URL, self.ADMIN_PASSWORD)
         self.levels = SETTINGS[countryCodeISO3]['levels']
         self.admin_level = admin_level
+        self.uploadWorkers = SETTINGS[countryCodeISO3].get('API_UPLOAD_WORKERS', API_UPLOAD_WORKERS)
+        self.rasterUploadCog = SETTINGS[countryCodeISO3].get('RASTER_UPLOAD_COG', RASTER_UPLOAD_COG)
+        self.spool = UploadSpool()
         current_time = datetime.datetime.now()
         
         self.uploadTime = current_time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
     def upload(self):
+        # uploads of earlier runs go first, so they do not overwrite the ones of this run
+        self.replaySpool()
         self.uploadTriggersPerLeadTime()
         self.uploadTriggerPerStation()
         self.uploadCalculatedAffected()
@@ -45,15 +57,23 @@ class DatabaseManager:
             self.uploadImage()
     
     def sendNotification(self):
+        """
+        Send the notification of the country. It is not spooled, as a replay would send it late or
+        twice, and not sent if uploads of this run are pending, as the API would notify on partial data.
+        """
         leadTimes = SETTINGS[self.countryCodeISO3]['lead_times']
         max_leadTime = max(leadTimes, key=leadTimes.get)
 
         if SETTINGS[self.countryCodeISO3]["notify_email"] and self.leadTimeLabel == max_leadTime:
+            pendingUploads = self.spool.count([self.countryCodeISO3], run=True)
+            if pendingUploads:
+                logger.error(f'PIPELINE ERROR: notification not sent, {pendingUploads} uploads of this run are pending')
+                return
             body = {
                 'countryCodeISO3': self.countryCodeISO3,
                 'disasterType': self.getDisasterType()
             } 
-            self.apiPostRequest('notification/send', body=body)
+            self.apiPostRequest('notification/send', body=body, spool=False)
 
     
     def getDisasterType(self):
@@ -80,62 +100,95 @@ class DatabaseManager:
                 logger.info('Uploaded calculated_affected for indicator: ' + 'population_affected_percentage for admin level: ' + str(adminlevels))
 
     def uploadCalculatedAffected(self):
+        """
+        Upload the exposure per admin level and indicator, concurrently (API_UPLOAD_WORKERS). The
+        alert thresholds are uploaded after all other indicators, as the API sets the event areas
+        from them. Uploads the API did not accept are spooled (see apiPostRequest), and so are the
+        alert thresholds after them. Returns a report of the uploads, and raises a ValueError if
+        any upload failed otherwise.
+        """
+        uploads = []
+        alertThresholds = []
         for adminlevels in SETTINGS[self.countryCodeISO3]['levels']:#range(1,self.admin_level+1):            
             for indicator, values in self.EXPOSURE_DATA_SOURCES.items():
                 if indicator == 'population':
-                    with open(self.affectedFolder +
-                            'affected_' + self.leadTimeLabel + '_' + self.countryCodeISO3  + '_admin_' + str(adminlevels) + '_' + 'population_affected_percentage' + '.json') as json_file:
-                        body = json.load(json_file)
-                        body['disasterType'] = self.getDisasterType()
-                        body['date']=self.uploadTime
-                        #body['adminLevel'] = self.admin_level
-                        self.apiPostRequest('admin-area-dynamic-data/exposure', body=body)
-                    logger.info('Uploaded calculated_affected for indicator: ' + 'population_affected_percentage for admin level: ' + str(adminlevels))
-                    with open(self.affectedFolder+'affected_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adminlevels) + '_' + indicator + '.json') as json_file:
-                        body = json.load(json_file)
-                        #body['disasterType'] = self.getDisasterType()
-                        #body['adminLevel'] = self.admin_level
-                        body['disasterType'] = self.getDisasterType()
-                        body['date']=self.uploadTime
-                        self.apiPostRequest('admin-area-dynamic-data/exposure', body=body)
-                    logger.info(f'Uploaded calculated_affected for indicator: {indicator}' +'for admin level: ' + str(adminlevels))
-                    indicator2 = 'alert_threshold'
-                    with open(self.affectedFolder +
-                                'affected_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adminlevels) + '_' + indicator2 + '.json') as json_file:
-                        body = json.load(json_file)
-                        body['disasterType'] = self.getDisasterType()
-                        body['date']=self.uploadTime
-                        self.apiPostRequest('admin-area-dynamic-data/exposure', body=body)
-                        
-                    logger.info(f'Uploaded calculated_affected for indicator: {indicator2}' +'for admin level: ' + str(adminlevels))
+                    uploads.append((adminlevels, 'population_affected_percentage'))
+                    uploads.append((adminlevels, indicator))
+                    alertThresholds.append((adminlevels, 'alert_threshold'))
                 else:
-                    with open(self.affectedFolder +'affected_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adminlevels) + '_' + indicator + '.json') as json_file:
-                        body = json.load(json_file)
-                        body['disasterType'] = self.getDisasterType()
-                        body['date']=self.uploadTime
-                        #body['adminLevel'] = self.admin_level
-                        self.apiPostRequest('admin-area-dynamic-data/exposure', body=body)
-                    logger.info(f'Uploaded calculated_affected for indicator: {indicator}' +'for admin level: ' + str(adminlevels))                                    
-                    
-
+                    uploads.append((adminlevels, indicator))
 
             if self.countryCodeISO3 == 'MWII':
                 for indicator, values in self.EXPOSURE_DATA_UBR_SOURCES.items():
-                    affectedIndicatorPath = self.affectedFolder + \
-                            'affected_' + self.leadTimeLabel + '_' + self.countryCodeISO3  + '_admin_' + str(adminlevels) + '_' + indicator + '.json'
-                    with open(affectedIndicatorPath) as json_file:
-                        body = json.load(json_file)
-                        body['disasterType'] = self.getDisasterType()
-                        body['date']=self.uploadTime
-                        self.apiPostRequest('admin-area-dynamic-data/exposure', body=body)
-                        logger.info('Uploaded calculated_affected for indicator: ' + f'{indicator} for admin level: ' + str(adminlevels))
+                    uploads.append((adminlevels, indicator))
+
+        startTime = time.time()
+        report = {'uploaded': [], 'spooled': [], 'failed': [], 'skipped': []}
+        for batch in [uploads, alertThresholds]:
+            if report['failed']:
+                report['skipped'] += [{'adminLevel': adminLevel, 'indicator': indicator} for adminLevel, indicator in batch]
+                continue
+            with ThreadPoolExecutor(max_workers=self.uploadWorkers) as executor:
+                futures = {executor.submit(self.uploadExposure, adminLevel, indicator): (adminLevel, indicator)
+                           for adminLevel, indicator in batch}
+                for future in as_completed(futures):
+                    adminLevel, indicator = futures[future]
+                    try:
+                        uploaded = future.result()
+                        report['uploaded' if uploaded else 'spooled'].append({'adminLevel': adminLevel, 'indicator': indicator})
+                    except Exception as e:
+                        logger.error(f'Upload of calculated_affected for indicator: {indicator} for admin level: {adminLevel} failed: {e}')
+                        report['failed'].append({'adminLevel': adminLevel, 'indicator': indicator, 'error': str(e)})
+        report['seconds'] = round(time.time() - startTime, 1)
+
+        logger.info(f"Uploaded calculated_affected in {report['seconds']} s: {len(report['uploaded'])} uploaded, "
+                    f"{len(report['spooled'])} spooled, {len(report['failed'])} failed, {len(report['skipped'])} skipped")
+        if report['failed']:
+            raise ValueError(f"Upload of calculated_affected failed for {len(report['failed'])} indicators")
+        return report
+
+    def uploadExposure(self, adminLevel, indicator):
+        body = dict(ResultBus.load(self.affectedFolder + 'affected_' + self.leadTimeLabel + '_' + self.countryCodeISO3 +
+                                   '_admin_' + str(adminLevel) + '_' + indicator + '.json'))
+        body['disasterType'] = self.getDisasterType()
+        body['date'] = self.uploadTime
+        if not self.apiPostRequest('admin-area-dynamic-data/exposure', body=body, retries=API_UPLOAD_RETRIES):
+            return False
+        logger.info(f'Uploaded calculated_affected for indicator: {indicator} for admin level: {adminLevel}')
+        return True
 
     def uploadRasterFile(self):
+        """
+        Upload the flood extent, optionally converted to a Cloud Optimized GeoTIFF (RASTER_UPLOAD_COG)
+        in a temporary file, removed after the upload (the spool keeps a copy if it failed).
+        The file is streamed from disk in chunks, not read into memory.
+        """
         disasterType = self.getDisasterType()
         rasterFile = RASTER_OUTPUT + '0/flood_extents/flood_extent_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + '.tif'
-        files = {'file': open(rasterFile,'rb')}
-        self.apiPostRequest('admin-area-dynamic-data/raster/' + disasterType, files=files)
-        logger.info(f'Uploaded raster-file: {rasterFile}')
+        uploadFile = self.convertToCog(rasterFile) if self.rasterUploadCog else rasterFile
+        try:
+            startTime = time.time()
+            # under the name of the flood extent, also if converted
+            with MultipartStream('file', uploadFile, os.path.basename(rasterFile)) as stream:
+                if not self.apiPostRequest('admin-area-dynamic-data/raster/' + disasterType, stream=stream):
+                    return
+            # the rate over all attempts, as a retry sends the file again
+            seconds = max(time.time() - startTime, 1e-6)
+            logger.info(f'Uploaded raster-file: {uploadFile} ({len(stream) / 2**20:.1f} MB in {seconds:.1f} s, '
+                        f'{len(stream) / 2**20 / seconds:.1f} MB/s)')
+        finally:
+            if uploadFile != rasterFile:
+                os.remove(uploadFile)
+
+    def convertToCog(self, rasterFile):
+        """Copy of a raster as a Cloud Optimized GeoTIFF (temporary file): tiled, compressed and with overviews"""
+        fd, cogFile = tempfile.mkstemp(suffix='_cog.tif', dir=os.path.dirname(rasterFile))
+        os.close(fd)
+        rasterio.shutil.copy(rasterFile, cogFile, driver='COG', compress=RASTER_UPLOAD_COG_COMPRESS,
+                             blocksize=512, overviews='AUTO', overview_resampling='nearest')
+        logger.info(f'Converted {rasterFile} to a Cloud Optimized GeoTIFF: {os.path.getsize(rasterFile) / 2**20:.1f} MB '
+                    f'to {os.path.getsize(cogFile) / 2**20:.1f} MB')
+        return cogFile
 
     def uploadImage(self,eventName='no-name'):
         disasterType = self.getDisasterType()
@@ -143,29 +196,24 @@ class DatabaseManager:
         
         imageFile = PIPELINE_OUTPUT + self.countryCodeISO3 + '_' +self.leadTimeLabel +'_floods-map-image.png'     
         
-        files = {
-            'image': (imageFile, open(imageFile, 'rb'), "image/png"), 
-            }
-        
         data = {"submit": "Upload Image" }
         
         path_=f'event/event-map-image/{self.countryCodeISO3}/{disasterType}/{eventName}'          
         
-        self.apiPostRequestImage(path_,
-                                 files=files,
-                                 data=data
-                                 )
+        with open(imageFile, 'rb') as image:
+            files = {
+                'image': (imageFile, image, "image/png"), 
+                }
+            self.apiPostRequestImage(path_,
+                                     files=files,
+                                     data=data
+                                     )
         logger.info(f'Uploaded image-file: {imageFile}')
 
 
     def uploadTriggerPerStation(self):
-        df = pd.read_json(self.triggerFolder +
-                          'triggers_rp_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + ".json", orient='records')
-        
         filename= self.triggerFolder +'triggers_rp_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + ".json"
-
-        with open(filename) as json_file:
-            triggers = json.load(json_file) 
+        triggers = ResultBus.load(filename)
 
         stationForecasts = []
         for key in triggers:
@@ -198,59 +246,31 @@ class DatabaseManager:
             "stationForecasts": stationForecasts
         }
 
-        dfStation = pd.DataFrame(index=df.index)
-        dfStation['stationCode'] = df['stationCode']
-        dfStation['forecastLevel'] = df['fc'].astype(np.float64,errors='ignore')
-        #dfStation['forecastProbability'] = df['fc_prob'].astype(np.float64,errors='ignore')
-        #dfStation['forecastTrigger'] = df['fc_trigger'].astype(np.int32,errors='ignore')
-        dfStation['eapAlertClass'] = df['eapAlertClass']
-        dfStation['forecastReturnPeriod'] = df['fc_rp'].astype(np.int32,errors='ignore')
-        dfStation['triggerLevel'] = df['triggerLevel'].astype(np.int32,errors='ignore')
-        stationForecasts = json.loads(dfStation.to_json(orient='records'))
-
-        body2 = {
-            'countryCodeISO3': self.countryCodeISO3,
-            'leadTime': self.leadTimeLabel,
-            'date': self.uploadTime,
-            'stationForecasts': stationForecasts
-        }
         #body['disasterType'] = self.getDisasterType()
         print(body)
-        self.apiPostRequest('glofas-stations/triggers', body=body)
-        logger.info('Uploaded triggers per station')
+        if self.apiPostRequest('glofas-stations/triggers', body=body):
+            logger.info('Uploaded triggers per station')
 
     def uploadTriggersPerLeadTime(self):
-        with open(self.triggerFolder +
-                  'trigger_per_day_' + self.countryCodeISO3 + ".json") as json_file:
-            triggers = json.load(json_file)[0]
-            triggersPerLeadTime = []
-            for key in triggers:
-                triggersPerLeadTime.append({
-                    'leadTime': str(key),
-                    'triggered': triggers[key]
-                })
-            body = {
-                'countryCodeISO3': self.countryCodeISO3,
-                'disasterType': self.getDisasterType(),
-                'triggersPerLeadTime': triggersPerLeadTime
-            }
-            #body['disasterType'] = self.getDisasterType()
-            body['date']=self.uploadTime
-            self.apiPostRequest('event/triggers-per-leadtime', body=body)
-        logger.info('Uploaded triggers per leadTime')
+        triggers = ResultBus.load(self.triggerFolder + 'trigger_per_day_' + self.countryCodeISO3 + ".json")[0]
+        triggersPerLeadTime = []
+        for key in triggers:
+            triggersPerLeadTime.append({
+                'leadTime': str(key),
+                'triggered': triggers[key]
+            })
+        body = {
+            'countryCodeISO3': self.countryCodeISO3,
+            'disasterType': self.getDisasterType(),
+            'triggersPerLeadTime': triggersPerLeadTime
+        }
+        #body['disasterType'] = self.getDisasterType()
+        body['date']=self.uploadTime
+        if self.apiPostRequest('event/triggers-per-leadtime', body=body):
+            logger.info('Uploaded triggers per leadTime')
 
     def apiGetRequest(self, path, countryCodeISO3):
-        TOKEN = self.apiAuthenticate()
-        
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        response = session.get(
-            self.API_SERVICE_URL + path + '/' + countryCodeISO3,
-            headers={'Authorization': 'Bearer ' + TOKEN}
-        )
+        response = self.api.request('GET', path + '/' + countryCodeISO3)
 
         '''
         response = requests.get(
@@ -261,13 +281,55 @@ class DatabaseManager:
         data = response.json()
         return(data)
 
-    def apiPostRequest(self, path, body=None, files=None):
-        TOKEN = self.apiAuthenticate()
-
+    def apiPostRequest(self, path, body=None, files=None, retries=0, stream=None, spool=True):
+        """
+        Post to the API, returns True if the API accepted it. The upload is recorded in the spool
+        (UploadSpool) before it is sent, and kept there if it fails, to be replayed later; False is
+        returned then. While earlier uploads of the country and lead time failed in this run, the
+        upload is spooled without sending it, so they reach the API in order. Posts with files, or
+        without spool, are not spooled, they raise a ValueError if the API returns an error.
+        """
+        if files != None or not spool:
+            r = self.sendPostRequest(path, body=body, files=files, retries=retries, stream=stream)
+            if r.status_code >= 400:
+                #logger.info(r.text)
+                logger.error("PIPELINE ERROR")
+                raise ValueError(f'{path}: {r.status_code}')
+            return True
+
+        uploadId = self.spool.add(self.countryCodeISO3, self.leadTimeLabel, path, body=body, stream=stream)
+        rejected = False
+        blocked = self.spool.isBlocked(uploadId)
+        if blocked:
+            error = 'earlier uploads pending'
+        else:
+            try:
+                r = self.sendPostRequest(path, body=body, retries=retries, stream=stream)
+            except IOError as e:
+                error = e
+            else:
+                if r.status_code < 400:
+                    self.spool.remove(uploadId)
+                    return True
+                error = f'{path}: {r.status_code}'
+                # the API will not accept it on a replay either, unless the login or rate limit failed
+                rejected = r.status_code < 500 and r.status_code not in [401, 408, 429]
+        status = self.spool.keep(uploadId, error, rejected, attempted=not blocked)
+        logger.error(f"PIPELINE ERROR: upload to {path} {'spooled' if status == 'pending' else status} ({error})")
+        return False
+
+    def sendPostRequest(self, path, body=None, files=None, retries=0, stream=None):
+        """
+        Post to the API, returns the response. Server errors (5xx) and connection errors are retried
+        up to retries times, with exponential backoff (API_UPLOAD_BACKOFF). A stream (MultipartStream)
+        is sent as the body while it is read.
+        """
         if body != None:
-            headers={'Authorization': 'Bearer ' + TOKEN, 'Content-Type': 'application/json', 'Accept': 'application/json'}
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'}
         elif files != None:
-            headers={'Authorization': 'Bearer ' + TOKEN}
+            headers={}
+        elif stream != None:
+            headers={'Content-Type': stream.contentType}
         '''
         r = requests.post(
             self.API_SERVICE_URL + path,
@@ -276,43 +338,70 @@ class DatabaseManager:
             headers=headers
         )
         '''
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-      
-
-        r = session.post(
-            self.API_SERVICE_URL + path,
-            json=body,
-            files=files,
-            headers=headers
-        )
-         
-        if r.status_code >= 400:
-            #logger.info(r.text)
-            logger.error("PIPELINE ERROR")
-            raise ValueError()
-        
-    def apiPostRequestImage(self, path,files=None,data=None):
-        TOKEN = self.apiAuthenticate()
-
-        headers={'Authorization': 'Bearer ' + TOKEN}
+        for attempt in range(retries + 1):
+            if stream != None:
+                stream.seek(0)
+            try:
+                r = self.api.request('POST', path, json=body, files=files, data=stream, headers=headers)
+            except requests.exceptions.ConnectionError as e:
+                if attempt == retries:
+                    raise
+                logger.info(f'Connection error on {path} ({e}), retrying')
+            else:
+                if r.status_code < 500 or attempt == retries:
+                    break
+                logger.info(f'Server error {r.status_code} on {path}, retrying')
+            time.sleep(API_UPLOAD_BACKOFF * 2 ** attempt)
+        return r
 
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-      
+    def replaySpool(self):
+        """
+        Replay the pending uploads of the country and lead time in the spool, in order, until one
+        fails (uploads that are rejected, or fail for the last time, are skipped). Returns the number
+        of uploads replayed.
+        """
+        replayed = 0
+        for upload in self.spool.pending(self.countryCodeISO3, self.leadTimeLabel):
+            rejected = False
+            try:
+                if upload['fileName'] is not None:
+                    with MultipartStream('file', upload['filePath'], upload['fileName']) as stream:
+                        r = self.sendPostRequest(upload['path'], retries=API_UPLOAD_RETRIES, stream=stream)
+                else:
+                    r = self.sendPostRequest(upload['path'], body=json.loads(upload['body']), retries=API_UPLOAD_RETRIES)
+            except FileNotFoundError as e:
+                error, rejected = e, True
+            except IOError as e:
+                error = e
+            else:
+                if r.status_code < 400:
+                    self.spool.remove(upload['id'])
+                    replayed += 1
+                    continue
+                error = f"{upload['path']}: {r.status_code}"
+                rejected = r.status_code < 500 and r.status_code not in [401, 408, 429]
+            status = self.spool.keep(upload['id'], error, rejected)
+            logger.error(f"Replay of upload {upload['id']} to {upload['path']} failed ({error})")
+            if status == 'pending':
+                break
+        if replayed:
+            logger.info(f'Replayed {replayed} spooled uploads of {self.countryCodeISO3} {self.leadTimeLabel}')
+        return replayed
+
+    @classmethod
+    def replayUploads(cls, countryCodes=None):
+        """
+        Replay the pending uploads in the spool, the queues (country and lead time) concurrently
+        (UPLOAD_REPLAY_WORKERS). Returns the number of uploads replayed and still pending.
+        """
+        queues = UploadSpool().queues(countryCodes)
+        with ThreadPoolExecutor(max_workers=UPLOAD_REPLAY_WORKERS) as executor:
+            replayed = sum(executor.map(
+                lambda queue: cls(queue[1], queue[0], SETTINGS[queue[0]]['admin_level']).replaySpool(), queues))
+        return {'replayed': replayed, 'pending': UploadSpool().count(countryCodes)}
 
-        r = session.post(
-            self.API_SERVICE_URL + path,  
-            files=files,
-            data=data,
-            headers=headers
-        )
+    def apiPostRequestImage(self, path,files=None,data=None):
+        r = self.api.request('POST', path, files=files, data=data)
          
         if r.status_code >= 400:
             #logger.info(r.text)
@@ -321,12 +410,7 @@ class DatabaseManager:
         
 
     def apiAuthenticate(self):
-        API_LOGIN_URL=self.API_SERVICE_URL+'user/login'
-        
-        login_response = requests.post(API_LOGIN_URL, data=[(
-            'email', ADMIN_LOGIN), ('password', self.ADMIN_PASSWORD)])
-    
-        return login_response.json()['user']['token']
+        return self.api.authenticate()
 
     def getDataFromDatalake(self, path):
         import requests
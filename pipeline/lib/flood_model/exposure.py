@@ -2,24 +2,32 @@ import rasterio
 import rasterio.mask
 import rasterio.features
 import rasterio.warp
-from rasterio.features import shapes
-import fiona
+import rasterio.windows
+import rasterio.transform
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 import json
 from flood_model.settings import *
 import os
-import functools
+import hashlib
 from flood_model.dynamicDataDb import DatabaseManager
+from flood_model.zonalStats import ZonalStats, StreamingZonalSums, blockWindows
+from flood_model.rasterCache import RasterCache
+from flood_model.resultBus import ResultBus
 import geopandas
+from shapely.geometry import box
 import time
+import resource
+import tracemalloc
 import logging
 logger = logging.getLogger(__name__)
 class Exposure:
 
     """Class used to calculate the exposure per exposure type"""
 
+    populationIndexes = {}
+
     def __init__(self, leadTimeLabel, countryCodeISO3, admin_area_gdf, population_total, admin_level, district_mapping,pcodes):
         self.leadTimeLabel = leadTimeLabel
         self.admin_level = admin_level
@@ -27,8 +35,6 @@ class Exposure:
         self.selectedPcode = SETTINGS[countryCodeISO3]['selectedPcode']
         self.disasterExtentRaster = RASTER_OUTPUT + \
             '0/flood_extents/flood_extent_' + leadTimeLabel + '_' + countryCodeISO3 + '.tif'
-        self.selectionValue = 0.9
-        self.outputPath = PIPELINE_OUTPUT + "out.tif"
         self.district_mapping = district_mapping
         self.ADMIN_AREA_GDF = admin_area_gdf
         self.logoFile=logoPath 
@@ -50,105 +56,50 @@ class Exposure:
                 '_' + self.leadTimeLabel + ".tif"
                 
 
-        #self.ADMIN_AREA_GDF_TMP_PATH = os.path.join(PIPELINE_OUTPUT,"admin-areas_TMP.geojson")  #s.geojson', driver='GeoJSON')
-        self.ADMIN_AREA_GDF_TMP_PATH = PIPELINE_OUTPUT+"admin-areas_TMP.shp"   
         self.EXPOSURE_DATA_SOURCES = SETTINGS[countryCodeISO3]['EXPOSURE_DATA_SOURCES']
         if self.countryCodeISO3 == 'MWI':
             self.EXPOSURE_DATA_UBR_SOURCES = SETTINGS[countryCodeISO3]['EXPOSURE_DATA_UBR_SOURCES']
         
         self.levels = SETTINGS[countryCodeISO3]['levels']
         self.pcode_df=pcodes 
+        self.exposureStreaming = SETTINGS[countryCodeISO3].get('EXPOSURE_STREAMING', EXPOSURE_STREAMING)
+        self.triggeredPlaceCodes = None
         self.db = DatabaseManager(leadTimeLabel, countryCodeISO3,admin_level)
         if "population" in self.EXPOSURE_DATA_SOURCES:
             self.population_total = population_total
               
                    
     def callAllExposure(self):
+        stats = {}
         for indicator, values in self.EXPOSURE_DATA_SOURCES.items():
             logger.info(f'indicator: {indicator}')
             self.inputRaster = RASTER_INPUT + values['source'] + ".tif"
             #self.outputRaster = RASTER_OUTPUT + "0/" + values['source'] + self.leadTimeLabel
             self.outputRaster = RASTER_OUTPUT + "0/" + values['source'] + '_' + self.leadTimeLabel + ".tif"
-            
-            stats = self.calcAffected(self.disasterExtentRaster, indicator, values['rasterValue'])
-            df_stats=pd.DataFrame(stats) 
-            df_stats = pd.merge(self.pcode_df,df_stats,  how='left',left_on=f"placeCode_{self.admin_level}" , right_on ='placeCode')
- 
-  
-            #stats_dff = pd.merge(df,self.pcode_df,  how='left',left_on='placeCode', right_on = f'placeCode_{self.admin_level}')
-            for adm_level in SETTINGS[self.countryCodeISO3]['levels']:
-                logger.info(f'processing indicator: {indicator} for admin level{adm_level}')         
-                if adm_level==self.admin_level:
-                    df_stats_levl=stats
+            stats[indicator] = self.calcAffected(self.disasterExtentRaster, indicator, values['rasterValue'])
+
+        for adm_level, df_stats_levl in self.rollupAdminLevels(stats).items():
+            logger.info(f'processing indicators for admin level{adm_level}')
+            for indicator in stats:
+                if adm_level == self.admin_level:
+                    exposurePlaceCodes = stats[indicator]
                 else:
-                    df_stats_levl =df_stats.groupby(f'placeCode_{adm_level}').agg({'amount': 'sum'})
-                    df_stats_levl.reset_index(inplace=True)
-                    df_stats_levl['placeCode']=df_stats_levl[f'placeCode_{adm_level}']
-                    df_stats_levl=df_stats_levl[['amount','placeCode']].to_dict(orient='records')
+                    exposurePlaceCodes = df_stats_levl[[indicator, 'placeCode']].rename(
+                        columns={indicator: 'amount'}).to_dict(orient='records')
+                self.writeIndicator(exposurePlaceCodes, indicator, indicator + '_affected', adm_level, csv=True)
+
+            if self.population_total:
+                population_affected_percentage = self.get_population_affected_percentage(
+                    df_stats_levl[['population', 'placeCode']].rename(columns={'population': 'amount'}), adm_level)
+                self.writeIndicator(population_affected_percentage, 'population_affected_percentage',
+                                    'population_affected_percentage', adm_level, csv=True)
+
+            # define alert_threshold layer, from the last indicator
+            alert_threshold = pd.DataFrame({
+                'amount': (df_stats_levl[list(stats)[-1]] > 0).astype(int),
+                'placeCode': df_stats_levl['placeCode']})
+            self.writeIndicator(alert_threshold.to_dict(orient='records'), 'alert_threshold', 'alert_threshold', adm_level)
 
- 
-                self.statsPath = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
-                    self.leadTimeLabel + '_' + self.countryCodeISO3 +'_admin_' +str(adm_level) + '_' + indicator + '.json'
-                self.statsPathCsv = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
-                    self.leadTimeLabel + '_' + self.countryCodeISO3 +'_admin_' +str(adm_level) + '_' + indicator + '.csv'
-                result = {
-                    'countryCodeISO3': self.countryCodeISO3,
-                    'exposurePlaceCodes': df_stats_levl,
-                    'leadTime': self.leadTimeLabel,
-                    'dynamicIndicator': indicator + '_affected',
-                    'adminLevel': adm_level
-                }
-                df1 = pd.DataFrame(df_stats_levl)
-                df1['adminLevel']=adm_level
-                df1['leadTime']=adm_level
-                df1['dynamicIndicator']=indicator + '_affected'
-                df1.to_csv(self.statsPathCsv)
-                    
-                with open(self.statsPath, 'w') as fp:
-                    json.dump(result, fp)
-
-                if self.population_total:
-                    get_population_affected_percentage_ = functools.partial(self.get_population_affected_percentage, adm_level=adm_level)
-                    population_affected_percentage = list(map(get_population_affected_percentage_, df_stats_levl))
-                    #population_affected_percentage = list(map(self.get_population_affected_percentage, df_stats,adm_level))
-     
-                    population_affected_percentage_file_path = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
-                        self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adm_level) + '_' + 'population_affected_percentage' + '.json'
-                    population_affected_percentage_file_pathCsv = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
-                        self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adm_level) + '_' + 'population_affected_percentage' + '.csv'                        
-                    population_affected_percentage_records = {
-                        'countryCodeISO3': self.countryCodeISO3,
-                        'exposurePlaceCodes': population_affected_percentage, 
-                        'leadTime': self.leadTimeLabel,
-                        'dynamicIndicator': 'population_affected_percentage',
-                        'adminLevel': adm_level
-                    }
-                    df = pd.DataFrame(population_affected_percentage)
-                    df['adminLevel']=adm_level
-                    df['leadTime']=adm_level
-                    df['dynamicIndicator']='population_affected_percentage'
-                    df.to_csv(population_affected_percentage_file_pathCsv)
-
-                    with open(population_affected_percentage_file_path, 'w') as fp:
-                        json.dump(population_affected_percentage_records, fp)
-
-                    # define alert_threshold layer
-                alert_threshold = list(map(self.get_alert_threshold, df_stats_levl))
-
-                alert_threshold_file_path = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
-                    self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adm_level) + '_' + 'alert_threshold' + '.json'
-
-                alert_threshold_records = {
-                    'countryCodeISO3': self.countryCodeISO3,
-                    'exposurePlaceCodes': alert_threshold,
-                    'leadTime': self.leadTimeLabel,
-                    'dynamicIndicator': 'alert_threshold',
-                    'adminLevel': adm_level
-                }
-
-                with open(alert_threshold_file_path, 'w') as fp:
-                    json.dump(alert_threshold_records, fp)
-        
         if self.countryCodeISO3 == 'MWI':
             try:
                 self.UBR_ADM_PATH = os.path.join(self.PIPELINE_INPUT_COD, \
@@ -166,8 +117,7 @@ class Exposure:
                     df_indicator = population_ubr[[f'placeCode_{adm_level}', col_name]]
                     alert_threshold_file_path = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
                         self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adm_level) + '_' + 'alert_threshold' + '.json'
-                    with open(alert_threshold_file_path) as fp:
-                        alert_threshold = json.load(fp)
+                    alert_threshold = ResultBus.load(alert_threshold_file_path)
                     df_alert_threshold = pd.DataFrame(alert_threshold["exposurePlaceCodes"])#.set_index('placeCode').to_dict()
                     
                     df_stats = pd.merge(df_alert_threshold, df_indicator, \
@@ -192,31 +142,73 @@ class Exposure:
 
                     # self.to_json_api(self.countryCodeISO3, df_stats_levl, \
                     #     self.leadTimeLabel, indicator, adm_level, self.statsPath)
-                    with open(self.statsPath, 'w') as fp:
-                        json.dump(result, fp)
-
-
-    def get_alert_threshold(self, population_affected):
-        # population_total = next((x for x in self.population_total if x['placeCode'] == population_affected['placeCode']), None)
-        alert_threshold = 0
-        if (population_affected['amount'] > 0):
-            alert_threshold = 1
-        else:
-            alert_threshold = 0
-        return {
-            'amount': alert_threshold,
-            'placeCode': population_affected['placeCode']
+                    ResultBus.publish(self.statsPath, result)
+
+        RasterCache.logStats('exposure')
+
+    def rollupAdminLevels(self, stats):
+        """
+        Exposure of all indicators per admin level, as a frame with a column per indicator and
+        the placeCode: the stats of the admin level of the exposure, summed to the other levels
+        with pcode_df (one groupby per level for all indicators)
+        """
+        placeCodes = [x['placeCode'] for x in next(iter(stats.values()))]
+        df_stats = pd.DataFrame({indicator: [x['amount'] for x in records] for indicator, records in stats.items()})
+        df_stats['placeCode'] = placeCodes
+        df_pcodes = pd.merge(self.pcode_df, df_stats, how='left', left_on=f"placeCode_{self.admin_level}", right_on='placeCode')
+
+        levels = {}
+        for adm_level in self.levels:
+            if adm_level == self.admin_level:
+                levels[adm_level] = df_stats
+            else:
+                df_stats_levl = df_pcodes.groupby(f'placeCode_{adm_level}')[list(stats)].sum()
+                df_stats_levl.reset_index(inplace=True)
+                df_stats_levl['placeCode'] = df_stats_levl[f'placeCode_{adm_level}']
+                levels[adm_level] = df_stats_levl[list(stats) + ['placeCode']]
+        return levels
+
+    def writeIndicator(self, exposurePlaceCodes, name, dynamicIndicator, adm_level, csv=False):
+        statsPath = PIPELINE_OUTPUT + 'calculated_affected/affected_' + \
+            self.leadTimeLabel + '_' + self.countryCodeISO3 + '_admin_' + str(adm_level) + '_' + name
+        result = {
+            'countryCodeISO3': self.countryCodeISO3,
+            'exposurePlaceCodes': exposurePlaceCodes,
+            'leadTime': self.leadTimeLabel,
+            'dynamicIndicator': dynamicIndicator,
+            'adminLevel': adm_level
         }
-        
-    def get_population_affected_percentage(self, population_affected,adm_level):
-        ##get population for admin level
+        if csv:
+            df = pd.DataFrame(exposurePlaceCodes)
+            df['adminLevel'] = adm_level
+            df['leadTime'] = adm_level
+            df['dynamicIndicator'] = dynamicIndicator
+            ResultBus.publish(statsPath + '.csv', df, df.to_csv)
+
+        ResultBus.publish(statsPath + '.json', result)
+
+    def get_population_affected_percentage(self, population_affected, adm_level):
+        """Population affected as a fraction of the population total, for a list of affected records of an admin level"""
+        population_total = self.populationIndex(adm_level)
+        df_affected = pd.DataFrame(population_affected, columns=['amount', 'placeCode'])
+        population = pd.to_numeric(df_affected['placeCode'].map(population_total))
+        population_affected_percentage = (df_affected['amount'] / population).where(population > 0, 0.0)
+        return [{'amount': float(amount), 'placeCode': placeCode}
+                for amount, placeCode in zip(population_affected_percentage, df_affected['placeCode'])]
+
+    def populationIndex(self, adm_level):
+        """Population total per placeCode of an admin level, loaded once per country and level"""
+        key = (self.countryCodeISO3, adm_level)
+        if key in Exposure.populationIndexes:
+            return Exposure.populationIndexes[key]
         try:
             #df_stats = self.db.apiGetRequest('admin-area-data/{}/{}/{}'.format(self.countryCodeISO3, adm_level, 'populationTotal'),countryCodeISO3='')
-            self.POPULATION_PATH= os.path.join(self.PIPELINE_INPUT_COD,f"{self.countryCodeISO3}_{adm_level}_population.json") 
-            with open(self.POPULATION_PATH) as fp:
+            POPULATION_PATH= os.path.join(self.PIPELINE_INPUT_COD,f"{self.countryCodeISO3}_{adm_level}_population.json")
+            with open(POPULATION_PATH) as fp:
                 df_stats=json.load(fp)
         except Exception as e:
             logger.info('file not found')
+            raise
             '''
             logger.info(f'connection error while getting population data, waiting 60 seconds then trying again (1/2)')
             
@@ -232,133 +224,300 @@ class Exposure:
                     'admin-area-data/{}/{}/{}'.format(self.countryCodeISO3, adm_level, 'populationTotal'),
                     countryCodeISO3='')
             '''        
-        population_total = next((x for x in df_stats if x['placeCode'] == population_affected['placeCode']), None)
-        population_affected_percentage = 0.0
-        if population_total and population_total['value'] > 0:
-            population_affected_percentage = population_affected['amount'] / population_total['value']
-        return {
-            'amount': population_affected_percentage,
-            'placeCode': population_total['placeCode']
-        }
-    
-    def calcAffected(self, disasterExtentRaster, indicator, rasterValue):
-        disasterExtentShapes = self.loadTiffAsShapes(disasterExtentRaster)
-        if disasterExtentShapes != []:
-            try:
-                affectedImage, affectedMeta = self.clipTiffWithShapes(
-                    self.inputRaster, disasterExtentShapes)
-                with rasterio.open(self.outputRaster, "w", **affectedMeta) as dest:
-                    dest.write(affectedImage)
-            except ValueError:
-                logger.info('Rasters do not overlap')
-        #self.ADMIN_AREA_GDF_ADM_LEL_=self.ADMIN_AREA_GDF_ADM_LEL.query(f'adminLevel == {adm_level}')
-        self.ADMIN_AREA_GDF.to_file(self.ADMIN_AREA_GDF_TMP_PATH)
-        #self.ADMIN_AREA_GDF.to_file(self.ADMIN_AREA_GDF_TMP_PATH,driver='GeoJSON')
-        stats = self.calcStatsPerAdmin(indicator, disasterExtentShapes, rasterValue)
-        return stats
+        # the first record of a placeCode, as found by a scan of the file
+        population_total = {}
+        for x in df_stats:
+            population_total.setdefault(x['placeCode'], x['value'])
+        Exposure.populationIndexes[key] = population_total
+        return population_total
 
-    def calcStatsPerAdmin(self, indicator, disasterExtentShapes, rasterValue):
+    def calcAffected(self, disasterExtentRaster, indicator, rasterValue):
+        """
+        Exposure per admin area. Non-triggered areas are 0, so only the triggered areas are
+        calculated, and no raster is read if no area is triggered. The amount of a triggered
+        area is cached (EXPOSURE_CACHE) with the flood maps around it, and reused while those,
+        the input raster and the admin boundaries are unchanged (e.g. for the next lead time).
+        The cache keeps the amount for the latest flood maps of an area only.
+        The affected raster (outputRaster) is written on every call, over the whole disaster extent,
+        also when the amounts come from the cache (all-zero if there is no disaster extent).
+        """
+        placeCodes = [str(placeCode) for placeCode in self.ADMIN_AREA_GDF['placeCode']]
+        triggeredAreas = self.triggeredAreas()
+        if not triggeredAreas:
+            logger.info(f'No triggered areas, {indicator} exposure set to 0')
+            self.writeAffectedRaster(disasterExtentRaster)
+            return [{'amount': 0, 'placeCode': placeCode} for placeCode in placeCodes]
+
+        cache = self.loadExposureCache(disasterExtentRaster, indicator, rasterValue)
+        amounts = {}
+        if cache is not None:
+            areaKeys = self.areaKeys(disasterExtentRaster, cache['floodMaps'], triggeredAreas)
+            for placeCode in triggeredAreas:
+                if areaKeys[placeCode] in cache['amounts'].get(placeCode, {}):
+                    amounts[placeCode] = cache['amounts'][placeCode][areaKeys[placeCode]]
+        changedAreas = [placeCode for placeCode in triggeredAreas if placeCode not in amounts]
+        logger.info(f'{indicator} exposure of {len(triggeredAreas)} triggered areas, '
+                    f'{len(triggeredAreas) - len(changedAreas)} from the cache')
+
+        if changedAreas:
+            amounts.update(self.calcStatsPerAdmin(indicator, disasterExtentRaster, rasterValue, changedAreas))
+        else:
+            self.writeAffectedRaster(disasterExtentRaster)
+        if cache is not None:
+            # only the amount for the current flood maps of an area is kept
+            cachedAmounts = {placeCode: {areaKeys[placeCode]: amounts[placeCode]} for placeCode in triggeredAreas}
+            if any(cache['amounts'].get(placeCode) != cachedAmount for placeCode, cachedAmount in cachedAmounts.items()):
+                cache['amounts'].update(cachedAmounts)
+                self.saveExposureCache(cache)
+
+        return [{'amount': amounts.get(placeCode, 0), 'placeCode': placeCode} for placeCode in placeCodes]
+
+    def triggeredAreas(self):
+        """
+        placeCodes of the admin areas with a triggered station, from the triggers per station and
+        the station per district (first record of each). Built once per lead time.
+        """
+        if self.triggeredPlaceCodes is not None:
+            return self.triggeredPlaceCodes
         # Load trigger_data per station
         path = PIPELINE_DATA+'output/triggers_rp_per_station/triggers_rp_' + \
             self.leadTimeLabel + '_' + self.countryCodeISO3 + '.json'
-        df_triggers = pd.read_json(path, orient='records')
-        df_triggers = df_triggers.set_index("stationCode", drop=False)
+        df_triggers = pd.DataFrame(ResultBus.load(path))
+        if df_triggers.empty:
+            df_triggers = pd.DataFrame(columns=['stationCode', 'fc_trigger'])
+        trigger_per_station = df_triggers.drop_duplicates('stationCode').set_index('stationCode')['fc_trigger']
         # Load assigned station per district
-        #df_district_mapping = pd.read_json(json.dumps(self.district_mapping))
-        df_district_mapping=pd.DataFrame(self.district_mapping)
-        df_district_mapping = df_district_mapping.set_index("placeCode", drop=False)
-
-        stats = []
-        with fiona.open(self.ADMIN_AREA_GDF_TMP_PATH, "r") as shapefile:
-
-            # Clip affected raster per area
-            for area in shapefile:
-                if disasterExtentShapes != []:
-                    try:
-                        outImage, outMeta = self.clipTiffWithShapes(
-                            self.outputRaster, [area["geometry"]])
-
-                        # Write clipped raster to tempfile to calculate raster stats
-                        with rasterio.open(self.outputPath, "w", **outMeta) as dest:
-                            dest.write(outImage)
-
-                        statsDistrict = self.calculateRasterStats(indicator,  str(
-                            area['properties']['placeCode']), self.outputPath, rasterValue)
-
-                        # Overwrite non-triggered areas with positive exposure (due to rounding errors) to 0
-                        if self.checkIfTriggeredArea(df_triggers, df_district_mapping, str(area['properties']['placeCode'])) == 0:
-                            statsDistrict = {'amount': 0, 'placeCode': str(
-                                area['properties']['placeCode'])}
-                    except (ValueError, rasterio.errors.RasterioIOError):
-                        # If there is no disaster in the district set  the stats to 0
-                        statsDistrict = {'amount': 0, 'placeCode': str(
-                            area['properties']['placeCode'])}
-                else:
-                    statsDistrict = {'amount': 0, 'placeCode': str(
-                        area['properties']['placeCode'])}
-                stats.append(statsDistrict)
-        os.remove(self.ADMIN_AREA_GDF_TMP_PATH)
-        return stats
-
-    def checkIfTriggeredArea(self, df_triggers, df_district_mapping, pcode):
-        df_station_code = df_district_mapping[df_district_mapping['placeCode'] == pcode]
-        if df_station_code.empty:
-            return 0
-        station_code = df_station_code['glofasStation'][0]
-        if station_code == 'no_station':
-            return 0
-        df_trigger = df_triggers[df_triggers['stationCode'] == station_code]
-        if df_trigger.empty:
-            return 0
-        trigger = df_trigger['fc_trigger'][0]
-        return trigger
-
-    def calculateRasterStats(self, indicator, district, outFileAffected, rasterValue):
-        raster = rasterio.open(outFileAffected)
-        stats = []
-
-        array = raster.read(masked=True)
-        band = array[0]
-        theSum = band.sum() * rasterValue
-        stats.append({
-            'amount': float(str(theSum)),
-            'placeCode': district
-        })
-        return stats[0]
-
-    def loadTiffAsShapes(self, tiffLocaction):
-        allgeom = []
-        with rasterio.open(tiffLocaction) as dataset:
-            # Read the dataset's valid data mask as a ndarray.
-            image = dataset.read(1).astype(np.float32)
-            image[image >= 0] = 1
-            mask = dataset.dataset_mask()
-            theShapes = shapes(image, mask=mask, transform=dataset.transform)
-
-            # Extract feature shapes and values from the array.
-            for geom, val in theShapes:
-                if val >= self.selectionValue:
-                    # Transform shapes from the dataset's own coordinate
-                    # reference system to CRS84 (EPSG:4326).
-                    geom = rasterio.warp.transform_geom(
-                        dataset.crs, 'EPSG:4326', geom, precision=6)
-                    # Append everything to one geojson
-
-                    allgeom.append(geom)
-        return allgeom
-
-    def clipTiffWithShapes(self, tiffLocaction, shapes):
-        with rasterio.open(tiffLocaction) as src:
-            outImage, out_transform = rasterio.mask.mask(
-                src, shapes, crop=True)
-            outMeta = src.meta.copy()
+        df_district_mapping = pd.DataFrame(self.district_mapping, columns=['placeCode', 'glofasStation'])
+        station_per_district = df_district_mapping.drop_duplicates('placeCode').set_index('placeCode')['glofasStation']
+
+        placeCodes = pd.Index(pd.unique(self.ADMIN_AREA_GDF['placeCode'].astype(str)))
+        stations = station_per_district.reindex(placeCodes)
+        triggered = (stations.isin(trigger_per_station.index) & (stations != 'no_station')
+                     & (trigger_per_station.reindex(stations).values != 0))
+        self.triggeredPlaceCodes = list(placeCodes[triggered.values])
+        return self.triggeredPlaceCodes
+
+    def exposureCachePath(self, indicator):
+        return EXPOSURE_CACHE + 'exposure_' + self.countryCodeISO3 + '_' + indicator + '.json'
+
+    def loadExposureCache(self, disasterExtentRaster, indicator, rasterValue):
+        """
+        Cached amounts per area of an indicator, or None if the flood extent has no flood map per
+        district (FLOOD_EXTENT_CACHE) to key them on. The cache is emptied if the input raster,
+        the admin boundaries, the flood maps or the raster value changed.
+        """
+        extentCachePath = FLOOD_EXTENT_CACHE + 'flood_extent_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + '.json'
+        if not os.path.exists(extentCachePath) or not os.path.exists(disasterExtentRaster):
+            return None
+        with open(extentCachePath) as fp:
+            extentCache = json.load(fp)
+        stat = os.stat(disasterExtentRaster)
+        if extentCache['output'] != [stat.st_size, stat.st_mtime_ns]:
+            return None
+
+        src = RasterCache.open(self.inputRaster)
+        stat = os.stat(self.inputRaster)
+        fingerprint = hashlib.sha1(ZonalStats.gridKey(self.ADMIN_AREA_GDF, src.transform, (src.height, src.width)).encode())
+        fingerprint.update(f'{extentCache["fingerprint"]}:{stat.st_size}:{stat.st_mtime_ns}:{rasterValue}'.encode())
+        fingerprint = fingerprint.hexdigest()
+
+        cache = {'path': self.exposureCachePath(indicator), 'fingerprint': fingerprint, 'amounts': {}}
+        if os.path.exists(cache['path']):
+            with open(cache['path']) as fp:
+                cached = json.load(fp)
+            if cached['fingerprint'] == fingerprint:
+                cache['amounts'] = cached['amounts']
+        cache['floodMaps'] = extentCache['floodMaps']
+        return cache
+
+    def saveExposureCache(self, cache):
+        if not os.path.exists(EXPOSURE_CACHE):
+            os.makedirs(EXPOSURE_CACHE, exist_ok=True)
+        tmpPath = cache['path'] + '.tmp'
+        with open(tmpPath, 'w') as fp:
+            json.dump({'fingerprint': cache['fingerprint'], 'amounts': cache['amounts']}, fp)
+        os.replace(tmpPath, cache['path'])
+
+    def areaKeys(self, disasterExtentRaster, floodMaps, placeCodes):
+        """
+        Key per area of the flood maps its exposure depends on: the flood map of the area and of
+        the districts within one flood extent cell of it, as the extent is resampled at the edges
+        """
+        resolution = max(RasterCache.open(disasterExtentRaster).res)
+        admin_gdf = self.ADMIN_AREA_GDF.reset_index(drop=True)
+        pcodes = admin_gdf['placeCode'].astype(str)
+        areaKeys = {}
+        for placeCode in placeCodes:
+            area = admin_gdf[pcodes == placeCode]
+            left, bottom, right, top = area.total_bounds
+            neighbours = admin_gdf.sindex.query(box(left - resolution, bottom - resolution, right + resolution, top + resolution))
+            areaKeys[placeCode] = '|'.join(f'{pcode}:{floodMaps.get(pcode, "")}' for pcode in sorted(set(pcodes[neighbours])))
+        return areaKeys
+
+    def loadDisasterExtent(self, disasterExtentRaster):
+        """
+        Disaster extent (cells with a valid value >= 0) cropped to its bounding box, with
+        its transform and crs. Returns None if there is no disaster extent.
+        """
+        dataset = RasterCache.open(disasterExtentRaster)
+        extent = (dataset.read(1) >= 0) & (dataset.dataset_mask() > 0)
+        if not extent.any():
+            return None
+        rows = np.flatnonzero(extent.any(axis=1))
+        cols = np.flatnonzero(extent.any(axis=0))
+        window = rasterio.windows.Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        extent = extent[window.toslices()].astype(np.uint8)
+        return extent, dataset.window_transform(window), dataset.crs
+
+    def writeAffectedRaster(self, disasterExtentRaster, zoneSums=None):
+        """
+        Write the input raster masked to the disaster extent, cropped to the extent, as outputRaster.
+        The extent is resampled (nearest) onto the grid of the input raster and applied as an array,
+        window by window (RASTER_WINDOW_SIZE), so memory is bounded by the window size. The first
+        band of every window is added to zoneSums if given.
+        Returns False if there is no disaster extent on the input raster, the raster is all-zero then.
+        """
+        disasterExtent = self.loadDisasterExtent(disasterExtentRaster)
+        if disasterExtent is None:
+            self.writeEmptyAffectedRaster()
+            return False
+        extent, extentTransform, extentCrs = disasterExtent
+
+        src = RasterCache.open(self.inputRaster)
+        # window of the input raster covering the extent
+        left, bottom, right, top = rasterio.warp.transform_bounds(
+            extentCrs, src.crs, *rasterio.transform.array_bounds(extent.shape[0], extent.shape[1], extentTransform))
+        window = rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform)
+        window = rasterio.windows.Window.from_slices(
+            (int(np.floor(window.row_off)), int(np.ceil(window.row_off + window.height))),
+            (int(np.floor(window.col_off)), int(np.ceil(window.col_off + window.width))))
+        try:
+            window = window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+        except rasterio.errors.WindowError:
+            logger.info('Rasters do not overlap')
+            self.writeEmptyAffectedRaster()
+            return False
+
+        nodata = src.nodata if src.nodata is not None else 0
+        outMeta = src.meta.copy()
+        outMeta.update({"driver": "GTiff",
+                        "height": window.height,
+                        "width": window.width,
+                        "transform": src.window_transform(window)})
+
+        RasterCache.release(self.outputRaster)
+        with rasterio.open(self.outputRaster, "w", **outMeta) as dest:
+            for srcWindow in blockWindows(src, window, RASTER_WINDOW_SIZE):
+                outWindow = rasterio.windows.Window(srcWindow.col_off - window.col_off, srcWindow.row_off - window.row_off,
+                                                    srcWindow.width, srcWindow.height)
+                values = src.read(window=srcWindow)
+                affected = np.zeros(values.shape[1:], dtype=np.uint8)
+                rasterio.warp.reproject(extent, affected,
+                                        src_transform=extentTransform, src_crs=extentCrs,
+                                        dst_transform=src.window_transform(srcWindow), dst_crs=src.crs,
+                                        resampling=rasterio.warp.Resampling.nearest)
+                values = np.where(affected == 1, values, np.array(nodata, dtype=values.dtype))
+                dest.write(values, window=outWindow)
+
+                if zoneSums is not None:
+                    if src.nodata is None:
+                        valid = np.ones(values.shape[1:], dtype=bool)
+                    elif np.isnan(src.nodata):
+                        valid = ~np.isnan(values[0])
+                    else:
+                        valid = values[0] != src.nodata
+                    zoneSums.add(values[0], valid, src.window_transform(srcWindow))
+        return True
+
+    def writeEmptyAffectedRaster(self):
+        """
+        Write an all-zero outputRaster, on the grid of the input raster and cropped to the admin
+        areas, for when there is no disaster extent, so no affected raster of an earlier run is left
+        """
+        src = RasterCache.open(self.inputRaster)
+        left, bottom, right, top = rasterio.warp.transform_bounds(self.ADMIN_AREA_GDF.crs, src.crs,
+                                                                  *self.ADMIN_AREA_GDF.total_bounds)
+        window = rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform)
+        window = rasterio.windows.Window.from_slices(
+            (int(np.floor(window.row_off)), int(np.ceil(window.row_off + window.height))),
+            (int(np.floor(window.col_off)), int(np.ceil(window.col_off + window.width))))
+        try:
+            window = window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+        except rasterio.errors.WindowError:
+            window = rasterio.windows.Window(0, 0, 1, 1)
 
+        outMeta = src.meta.copy()
         outMeta.update({"driver": "GTiff",
-                        "height": outImage.shape[1],
-                        "width": outImage.shape[2],
-                        "transform": out_transform})
+                        "height": window.height,
+                        "width": window.width,
+                        "transform": src.window_transform(window)})
+
+        RasterCache.release(self.outputRaster)
+        with rasterio.open(self.outputRaster, "w", **outMeta) as dest:
+            for srcWindow in blockWindows(src, window, RASTER_WINDOW_SIZE):
+                outWindow = rasterio.windows.Window(srcWindow.col_off - window.col_off, srcWindow.row_off - window.row_off,
+                                                    srcWindow.width, srcWindow.height)
+                dest.write(np.zeros((src.count, srcWindow.height, srcWindow.width), dtype=src.dtypes[0]), window=outWindow)
+
+    def calcStatsPerAdmin(self, indicator, disasterExtentRaster, rasterValue, placeCodes):
+        """Exposure of the given (triggered) areas, from the input raster masked to the disaster extent"""
+        areas = self.ADMIN_AREA_GDF[self.ADMIN_AREA_GDF['placeCode'].astype(str).isin(placeCodes)]
+        if self.exposureStreaming:
+            # sum per admin area while writing the affected raster, one window in memory at a time
+            # trace the allocations only during the measurement, it slows down every allocation
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                # python 3.9+, else the peak of the tracing already running is reported
+                tracemalloc.reset_peak()
+            try:
+                zoneSums = StreamingZonalSums(self.ADMIN_AREA_GDF)
+                disasterExtentFound = self.writeAffectedRaster(disasterExtentRaster, zoneSums)
+                peakMemory = tracemalloc.get_traced_memory()[1]
+            finally:
+                if tracing:
+                    tracemalloc.stop()
+            logger.info(f'{indicator} exposure streamed in windows of {RASTER_WINDOW_SIZE} cells: '
+                        f'peak array memory {peakMemory / 2**20:.1f} MB, '
+                        f'peak process memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+        else:
+            zoneSums = None
+            disasterExtentFound = self.writeAffectedRaster(disasterExtentRaster)
+
+        allPlaceCodes = self.ADMIN_AREA_GDF['placeCode']
+        amounts = pd.Series(0.0, index=allPlaceCodes)
+        cellCounts = pd.Series(0, index=allPlaceCodes)
+        if disasterExtentFound and zoneSums is not None:
+            amounts, cellCounts = zoneSums.result()
+        elif disasterExtentFound:
+            try:
+                amounts, cellCounts = self.sumPerAdmin(self.outputRaster)
+            except rasterio.errors.RasterioIOError:
+                logger.info('No affected raster, exposure set to 0')
+
+        stats = {}
+        for placeCode, amount, cellCount in zip(areas['placeCode'], amounts[areas['placeCode']] * rasterValue,
+                                                cellCounts[areas['placeCode']]):
+            # set the stats of areas without disaster to 0
+            stats[str(placeCode)] = 0 if cellCount == 0 else float(amount)
+        return stats
 
-        return outImage, outMeta
+    def sumPerAdmin(self, raster):
+        """
+        Sum of a raster cropped from the input raster per admin area, and the number of
+        raster cells per area. The admin areas are rasterized once on the grid of the input
+        raster (see ZonalStats), the sums are one bincount over the window of the raster.
+        """
+        src = RasterCache.open(self.inputRaster)
+        zones = ZonalStats(self.ADMIN_AREA_GDF, src.transform, (src.height, src.width))
+        src = RasterCache.open(raster)
+        values = src.read(1, masked=True)
+        window = zones.window(src.transform, values.shape)
+        labels = zones.labels[window.toslices()]
+        amounts = zones.sum(values.filled(0), window)
+        cellCounts = np.bincount(labels[~np.ma.getmaskarray(values)], minlength=zones.nZones + 1)[1:]
+        return pd.Series(amounts, index=zones.placeCodes), pd.Series(cellCounts, index=zones.placeCodes)
 
     def makeMaps(self):
         import numpy as np
@@ -1,11 +1,18 @@
 import os
+import hashlib
+import glob
 import pandas as pd
 from pandas import DataFrame
 import json
 import geopandas as gpd
+import numpy as np
 import rasterio
-from rasterio.merge import merge
+import rasterio.features
+import rasterio.windows
 from flood_model.settings import *
+from flood_model.rasterCache import RasterCache
+from flood_model.resultBus import ResultBus
+from flood_model.zonalStats import ZonalStats, blockWindows
 import os
 import geopandas
 import logging
@@ -20,87 +27,163 @@ class FloodExtent:
         self.leadTimeValue = leadTimeValue
         self.countryCodeISO3 = countryCodeISO3
         self.inputPath = RASTER_INPUT + "flood_extent/"
-        self.outputPathAreas = PIPELINE_OUTPUT + 'flood_extents/'+ leadTimeLabel +'/'
         self.outputPathMerge = RASTER_OUTPUT + '0/flood_extents/flood_extent_'+ leadTimeLabel + '_' + countryCodeISO3 + '.tif'
+        self.extentCachePath = FLOOD_EXTENT_CACHE + 'flood_extent_' + leadTimeLabel + '_' + countryCodeISO3 + '.json'
         self.district_mapping = district_mapping
         self.ADMIN_AREA_GDF = admin_area_gdf
         self.Areas_With_GlofasStation=Areas_With_GlofasStation
 
     def calculate(self):
+        """
+        Compose the flood extent of the country from the return period flood map selected per
+        district (the empty map if the district is not triggered). The districts are rasterized
+        once to labels on the grid of the flood maps, and the extent is selected per pixel from
+        the few flood maps, window by window.
+        The flood map per district is saved with a fingerprint of the inputs (FLOOD_EXTENT_CACHE):
+        if nothing changed since the previous run the extent is kept, otherwise only the windows
+        with a changed district are composed again and the others copied from the previous extent.
+        """
         admin_gdf = self.ADMIN_AREA_GDF
         #admin_gdf.crs = "EPSG:4326"
         #if self.countryCodeISO3=='KEN':
         #    admin_gdf=admin_gdf.to_crs(4210)
 
         df_glofas = self.loadGlofasData()
-       
-
-        #Create new subfolder for current date
-        if not os.path.exists(self.outputPathAreas):
-            os.makedirs(self.outputPathAreas)
-        for the_file in os.listdir(self.outputPathAreas):
-            file_path = os.path.join(self.outputPathAreas, the_file)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                logger.info(e)
-        
-
-        #Loop through catchment-areas and clip right flood extent
-        for index, rows in df_glofas.iterrows():
-            #Filter the catchment-area GDF per area
-            pcode = rows['placeCode']
-            gdf_dist = admin_gdf[admin_gdf['placeCode'] == pcode]
-            
-            dist_coords = self.getCoordinatesFromGDF(gdf_dist)
-            
-            ### for PHL to save time process only districts with GLOFAS stations 
-            
-            #if pcode in Areas_With_GlofasStation:
-            
-            #If trigger, find the right flood extent and clip it for the area and save it
-            if self.countryCodeISO3 =='PHL':
-                if pcode in self.Areas_With_GlofasStation:
-                    #logger.info(f'procssing {pcode}')                
-                    #If trigger, find the right flood extent and clip it for the area and save it
-                    trigger = rows['fc_trigger']
-                    if trigger == 1:
-                        return_period = rows['fc_rp_flood_extent'] 
-                        input_raster = self.inputPath + self.countryCodeISO3 + '_flood_' +str(int(return_period))+'year.tif'
-                    else:
-                        input_raster = self.inputPath + self.countryCodeISO3 + '_flood_empty.tif'
-                    out_image, out_meta = self.clipTiffWithShapes(input_raster, dist_coords)                   
-
-                    with rasterio.open(self.outputPathAreas+ 'pcode_' + str(pcode) + ".tif", "w", **out_meta) as dest:
-                        dest.write(out_image)                       
+        districtRasters = self.selectFloodMaps(df_glofas)
+        if districtRasters.empty:
+            logger.info('No districts to calculate the flood extent for')
+            return
+        floodMaps = list(dict.fromkeys(districtRasters))
+
+        reference = RasterCache.open(floodMaps[0])
+        for floodMap in floodMaps[1:]:
+            self.checkGrid(reference, RasterCache.open(floodMap))
+        fingerprint = self.extentFingerprint(admin_gdf, reference)
+        assignment = {str(pcode): os.path.basename(floodMap) for pcode, floodMap in districtRasters.items()}
+        changedDistricts = self.changedDistricts(fingerprint, assignment)
+        if changedDistricts is not None and len(changedDistricts) == 0:
+            logger.info('Flood extent unchanged since the previous run')
+            RasterCache.logStats('flood extent')
+            return
+
+        zones = ZonalStats(admin_gdf, reference.transform, (reference.height, reference.width))
+        # flood map per zone label: 1-based index into floodMaps, 0 for districts without flood map
+        floodMapPerZone = np.zeros(zones.nZones + 1, dtype=np.uint8)
+        zoneIndex = pd.Series(np.arange(1, zones.nZones + 1), index=zones.placeCodes)
+        floodMapPerZone[zoneIndex[districtRasters.index].values] = [floodMaps.index(f) + 1 for f in districtRasters]
+        if changedDistricts is not None:
+            logger.info(f'Flood extent changed for {len(changedDistricts)} districts')
+            changedZone = np.zeros(zones.nZones + 1, dtype=bool)
+            changedZone[zoneIndex[[pcode for pcode in districtRasters.index if str(pcode) in changedDistricts]].values] = True
+
+        # window of the flood maps covering the selected districts
+        districts = admin_gdf[admin_gdf['placeCode'].isin(districtRasters.index)]
+        window = rasterio.features.geometry_window(reference, districts.geometry)
+
+        nodata = reference.nodata if reference.nodata is not None else 0
+        out_meta = reference.meta.copy()
+        out_meta.update({"driver": "GTiff",
+                         "height": window.height,
+                         "width": window.width,
+                         "transform": reference.window_transform(window),
+                         "compress": "lzw"})
+
+        RasterCache.release(self.outputPathMerge)
+        # write next to the previous extent, which is read for the unchanged windows
+        tmpPath = self.outputPathMerge + '.tmp'
+        with rasterio.open(tmpPath, "w", **out_meta) as dest:
+            previous = rasterio.open(self.outputPathMerge) if changedDistricts is not None else None
+            for block in blockWindows(reference, window, RASTER_WINDOW_SIZE):
+                labels = zones.labels[block.toslices()]
+                outWindow = rasterio.windows.Window(block.col_off - window.col_off, block.row_off - window.row_off,
+                                                    block.width, block.height)
+                if previous is not None and not changedZone[labels].any():
+                    dest.write(previous.read(window=outWindow), window=outWindow)
+                    continue
+
+                floodMapIndex = floodMapPerZone[labels]
+                extent = np.full((reference.count, block.height, block.width), nodata, dtype=reference.dtypes[0])
+                for i, floodMap in enumerate(floodMaps):
+                    if not (floodMapIndex == i + 1).any():
+                        continue
+                    src = RasterCache.open(floodMap)
+                    srcWindow = rasterio.windows.from_bounds(*reference.window_bounds(block), transform=src.transform)
+                    values = src.read(window=srcWindow.round_offsets().round_lengths(), boundless=True, fill_value=nodata)
+                    extent = np.where(floodMapIndex == i + 1, values, extent)
+                dest.write(extent, window=outWindow)
+            if previous is not None:
+                previous.close()
+        os.replace(tmpPath, self.outputPathMerge)
+        logger.info("Total flood extent file written")
+        self.saveExtentCache(fingerprint, assignment)
+        RasterCache.logStats('flood extent')
+
+    @staticmethod
+    def checkGrid(reference, src):
+        """
+        Raise a ValueError if a flood map is not on the grid of the reference flood map (crs,
+        resolution, and an origin a whole number of cells apart), as the maps are combined cell by cell
+        """
+        colOffset, rowOffset = ~reference.transform * (src.transform.c, src.transform.f)
+        if (src.crs != reference.crs or src.count != reference.count
+                or not np.allclose([src.transform.a, src.transform.b, src.transform.d, src.transform.e],
+                                   [reference.transform.a, reference.transform.b, reference.transform.d, reference.transform.e],
+                                   rtol=1e-9, atol=0)
+                or not np.allclose([colOffset, rowOffset], np.round([colOffset, rowOffset]), rtol=0, atol=1e-3)):
+            raise ValueError(f'Flood map {src.name} is not on the grid of {reference.name}: '
+                             f'{src.crs} {src.transform[:6]} {src.count} bands, '
+                             f'expected {reference.crs} {reference.transform[:6]} {reference.count} bands')
+
+    def extentFingerprint(self, admin_gdf, reference):
+        """Hash of the admin boundaries, the grid of the flood maps and the size and time of every flood map"""
+        fingerprint = hashlib.sha1(ZonalStats.gridKey(admin_gdf, reference.transform, (reference.height, reference.width)).encode())
+        fingerprint.update(str(reference.meta).encode())
+        for floodMap in sorted(glob.glob(self.inputPath + self.countryCodeISO3 + '_flood_*.tif')):
+            stat = os.stat(floodMap)
+            fingerprint.update(f'{os.path.basename(floodMap)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return fingerprint.hexdigest()
+
+    def outputStamp(self):
+        if not os.path.exists(self.outputPathMerge):
+            return None
+        stat = os.stat(self.outputPathMerge)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def changedDistricts(self, fingerprint, assignment):
+        """
+        Districts whose flood map changed since the previous run, or None if the previous extent
+        can not be reused (other inputs or districts, or the extent file was changed or removed)
+        """
+        if not os.path.exists(self.extentCachePath):
+            return None
+        with open(self.extentCachePath) as fp:
+            cached = json.load(fp)
+        if (cached['fingerprint'] != fingerprint or set(cached['floodMaps']) != set(assignment)
+                or cached['output'] != self.outputStamp()):
+            return None
+        return [pcode for pcode, floodMap in assignment.items() if cached['floodMaps'][pcode] != floodMap]
+
+    def saveExtentCache(self, fingerprint, assignment):
+        if not os.path.exists(FLOOD_EXTENT_CACHE):
+            os.makedirs(FLOOD_EXTENT_CACHE, exist_ok=True)
+        with open(self.extentCachePath, 'w') as fp:
+            json.dump({'fingerprint': fingerprint, 'floodMaps': assignment, 'output': self.outputStamp()}, fp)
+
+    def selectFloodMaps(self, df_glofas):
+        """Flood map per district placeCode: the return period map if triggered, else the empty map"""
+        df_glofas = df_glofas.drop_duplicates('placeCode', keep='last')
+        ### for PHL to save time process only districts with GLOFAS stations
+        if self.countryCodeISO3 =='PHL':
+            df_glofas = df_glofas[df_glofas['placeCode'].isin(self.Areas_With_GlofasStation)]
+
+        floodMaps = {}
+        for pcode, trigger, return_period in zip(df_glofas['placeCode'], df_glofas['fc_trigger'], df_glofas['fc_rp_flood_extent']):
+            if trigger == 1:
+                floodMaps[pcode] = self.inputPath + self.countryCodeISO3 + '_flood_' +str(int(return_period))+'year.tif'
             else:
-                trigger = rows['fc_trigger']
-                if trigger == 1:
-                    return_period = rows['fc_rp_flood_extent'] 
-                    input_raster = self.inputPath + self.countryCodeISO3 + '_flood_' +str(int(return_period))+'year.tif'
-                else:
-                    input_raster = self.inputPath + self.countryCodeISO3 + '_flood_empty.tif'
-             
-
-                out_image, out_meta = self.clipTiffWithShapes(input_raster, dist_coords)
-                
-
-                with rasterio.open(self.outputPathAreas+ 'pcode_' + str(pcode) + ".tif", "w", **out_meta) as dest:
-                    dest.write(out_image)
-                #logger.info(f"flood extent file written for {pcode}")
-
-        #Merge all clipped flood extents back together and Save
-        mosaic, out_meta = self.mergeRasters()
-        
-        out_meta.update({"compress": "lzw"}) #"dtype": 'int16',
-        
-        with rasterio.open(self.outputPathMerge, "w", **out_meta) as dest:
-            dest.write(mosaic)
-            logger.info("Total flood extent file written")
-            
+                floodMaps[pcode] = self.inputPath + self.countryCodeISO3 + '_flood_empty.tif'
+        return pd.Series(floodMaps, dtype=object)
 
-        
     def reproject_file(self, gdf, file_name, force_epsg):
 
         logger.info("Reprojecting %s to EPSG %i...\n" % (file_name, force_epsg), end="", flush=True)
@@ -114,46 +197,13 @@ class FloodExtent:
         
         #Load (static) threshold values per station
         path = PIPELINE_DATA+'output/triggers_rp_per_station/triggers_rp_' + self.leadTimeLabel + '_' + self.countryCodeISO3 + '.json'
-        df_triggers = pd.read_json(path, orient='records')
+        df_triggers = pd.DataFrame(ResultBus.load(path))
         
         #Merge two datasets
         df_glofas = pd.merge(df_district_mapping, df_triggers, left_on='glofasStation', right_on='stationCode', how='left')
 
         return df_glofas
 
-    def getCoordinatesFromGDF(self, gdf):
-        """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
-        return [json.loads(gdf.to_json())['features'][0]['geometry']]
-
-    def clipTiffWithShapes(self, tiffLocaction, shapes):
-        with rasterio.open(tiffLocaction) as src:
-            outImage, out_transform = rasterio.mask.mask(src, shapes, crop=True)
-            outMeta = src.meta.copy()
-        outMeta.update({"driver": "GTiff",
-                    "height": outImage.shape[1],
-                    "width": outImage.shape[2],
-                    "transform": out_transform,
-                    #"dtype": 'int16',
-                    "compress": "lzw"}) #
-
-        return outImage, outMeta
-
-    def mergeRasters(self):
-        src_files_to_mosaic = []
-        for fp in os.listdir(self.outputPathAreas):
-            if len(src_files_to_mosaic) == 0:
-                with rasterio.open(self.outputPathAreas+fp) as src:
-                    out_meta = src.meta.copy()
-            src_files_to_mosaic.append(self.outputPathAreas+fp)
-        if len(src_files_to_mosaic) > 0:
-            mosaic, out_trans = merge(src_files_to_mosaic)
-            out_meta.update({"driver": "GTiff",
-                            "height": mosaic.shape[1],
-                            "width": mosaic.shape[2],
-                            "transform": out_trans,
-                        })
-        return mosaic, out_meta
-
     def zmpcode(self,x):
         if len(str(x))==9:
             pcoded=str(x)
@@ -14,9 +14,11 @@ logger = logging.getLogger(__name__)
 
 
 class Forecast:
-    def __init__(self, leadTimeLabel, leadTimeValue, countryCodeISO3, admin_level):
+    def __init__(self, leadTimeLabel, leadTimeValue, countryCodeISO3, admin_level, leadTimes=None):
         self.leadTimeLabel = leadTimeLabel
         self.leadTimeValue = leadTimeValue
+        # with several lead times the inputs are parsed and the glofas data processed once for all of them
+        self.leadTimes = leadTimes if leadTimes is not None else {leadTimeLabel: leadTimeValue}
         self.countryCodeISO3=countryCodeISO3
         self.admin_level = admin_level
         self.db = DatabaseManager(leadTimeLabel, countryCodeISO3,admin_level)
@@ -128,15 +130,22 @@ class Forecast:
         dic_glofas_stations = df_glofas_stations.to_dict(orient='records')
         self.glofas_stations = dic_glofas_stations
      
-        self.glofasData = GlofasData(leadTimeLabel, leadTimeValue, countryCodeISO3, self.glofas_stations, self.district_mapping,self.admin_area_gdf)
-        self.floodExtent = FloodExtent(leadTimeLabel, leadTimeValue, countryCodeISO3, self.district_mapping, self.admin_area_gdf)
-        self.exposure = Exposure(leadTimeLabel, countryCodeISO3, self.admin_area_gdf, self.population_total, self.admin_level, self.district_mapping,self.pcode_df)
+        self.glofasData = GlofasData(leadTimeLabel, leadTimeValue, countryCodeISO3, self.glofas_stations, self.district_mapping,self.admin_area_gdf, self.leadTimes)
+        self.setLeadTime(leadTimeLabel, leadTimeValue)
 
-        stationNAmesfile=PIPELINE_INPUT +'glofasStaions.json'
+        stationNAmesfile=PIPELINE_INPUT + countryCodeISO3 + '_glofasStaions.json'
         with open(stationNAmesfile, 'w') as fp:
             json.dump(dic_glofas_stations, fp)
  
         
+    def setLeadTime(self, leadTimeLabel, leadTimeValue):
+        """Set up the flood extent, exposure and upload of one lead time on the already parsed inputs"""
+        self.leadTimeLabel = leadTimeLabel
+        self.leadTimeValue = leadTimeValue
+        self.db = DatabaseManager(leadTimeLabel, self.countryCodeISO3, self.admin_level)
+        self.floodExtent = FloodExtent(leadTimeLabel, leadTimeValue, self.countryCodeISO3, self.district_mapping, self.admin_area_gdf)
+        self.exposure = Exposure(leadTimeLabel, self.countryCodeISO3, self.admin_area_gdf, self.population_total, self.admin_level, self.district_mapping,self.pcode_df)
+
     def pcode1(self,x):
         len_x=len(x)-2
         if x.startswith('ZM'):
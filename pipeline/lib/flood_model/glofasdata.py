@@ -2,12 +2,15 @@ import netCDF4
 import xarray as xr
 import numpy as np
 import os
+import io
 from os import listdir
 from os.path import isfile, join
 import pandas as pd
 from pandas import DataFrame 
 import rioxarray
 import rasterio as rio
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm 
 import geocube 
 import re
@@ -20,9 +23,14 @@ import urllib.request
 import urllib.error
 import tarfile
 import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from ftplib import FTP
 #import cdsapi
 from flood_model.dynamicDataDb import DatabaseManager
+from flood_model.zonalStats import ZonalStats
+from flood_model.returnPeriods import classifyReturnPeriods
+from flood_model.resultBus import ResultBus
 from flood_model.settings import *
 try:
     from flood_model.secrets import *
@@ -33,14 +41,91 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def zonalMaxPerPcode(zones, pcodes, nc_p, variables, placeCodeInitial, placecodeLen):
+    """Maximum of each glofas variable per admin area, ordered by pcode"""
+    zonal_stats_df = pd.DataFrame({'pcode': pcodes})
+    for gof_var in variables:
+        zonal_stats_df[gof_var] = zones.max(nc_p[gof_var].values)
+    zonal_stats_df = zonal_stats_df[zones.count > 0].sort_values('pcode').reset_index(drop=True)
+    zonal_stats_df['pcode']=zonal_stats_df['pcode'].apply(lambda x:placeCodeInitial + str(int(x)).zfill(placecodeLen))
+    return zonal_stats_df
+
+
+def zonalMaxToFrame(zones, pcodes, maxima, ensembles, placeCodeInitial, placecodeLen):
+    """
+    Frame of zonal maxima per lead day, ensemble and admin area, with the same rows and
+    index as the per lead day extraction. maxima holds an array per glofas variable
+    that broadcasts to (lead day, ensemble, zone).
+    """
+    present = np.flatnonzero(zones.count > 0)
+    present = present[np.argsort(pcodes[present])]
+    nLeadTimes = 7
+    nBlocks = nLeadTimes * len(ensembles)
+    glofasDffinal = pd.DataFrame({
+        'pcode': np.tile([placeCodeInitial + str(int(x)).zfill(placecodeLen) for x in pcodes[present]], nBlocks),
+        'ensemble': np.repeat(np.tile(ensembles, nLeadTimes), len(present)),
+        'leadTime': np.repeat([str(i+1)+'_day' for i in range(nLeadTimes)], len(ensembles) * len(present))},
+        index=np.tile(np.arange(len(present)), nBlocks))
+    for gof_var, values in maxima.items():
+        values = np.broadcast_to(values, (nLeadTimes, len(ensembles), zones.nZones))
+        glofasDffinal[gof_var] = values[:, :, present].reshape(-1)
+    return glofasDffinal
+
+
+def extractEnsembleZonalMax(Filename, bf_gpd, ens, placeCodeInitial, placecodeLen):
+    """
+    Extract the maximum discharge per admin area and lead day from one downloaded
+    ensemble member and remove the netcdf file.
+    Module level so it can run in a process pool.
+    """
+    bbox_bfs=list(bf_gpd.total_bounds)
+    with xr.open_dataset(Filename) as nc_file:
+        var_data =nc_file.sel(lat=slice(bbox_bfs[3], bbox_bfs[1]),lon=slice(bbox_bfs[0], bbox_bfs[2])).rio.write_crs("epsg:4326")
+        zones = ZonalStats(bf_gpd, var_data.rio.transform(), var_data.rio.shape)
+        pcodes = bf_gpd.drop_duplicates('placeCode').set_index('placeCode')['pcode'].reindex(zones.placeCodes).values
+
+        if GLOFAS_GRID_STREAMING:
+            # read only the admin window, one lead day at a time
+            dis = var_data['dis'].isel(time=slice(0,7)).chunk({'time': 1, 'lat': -1, 'lon': -1})
+            maxima = {'dis': zones.lazyMax(dis.transpose('time', 'lat', 'lon').data)[:, None, :]}
+            glofasDffinal = zonalMaxToFrame(zones, pcodes, maxima, [ens], placeCodeInitial, placecodeLen)
+        else:
+            df_leadtime_ens=[]
+            for i in range(0,7):
+                leadTimelabel=str(i+1)+'_day'
+                zonal_stats_df = zonalMaxPerPcode(zones, pcodes, var_data.isel(time=i), ['dis'], placeCodeInitial, placecodeLen)
+                zonal_stats_df['ensemble']=ens
+                zonal_stats_df['leadTime']=leadTimelabel
+                df_leadtime_ens.append(zonal_stats_df.filter(['pcode','ensemble','leadTime','dis','rl2','rl5','rl20']))
+            glofasDffinal = pd.concat(df_leadtime_ens)
+
+    os.remove(Filename)
+    return glofasDffinal
+
+
+def glofasGridTable(glofasDffinal):
+    """
+    Typed arrow table of the zonal maxima, with dictionary encoded (categorical) pcode and leadTime.
+    The discharge keeps the dtype of the grid (see readGlofasGridExtraction).
+    """
+    return pa.table({
+        'pcode': pa.array(glofasDffinal['pcode'].astype(str)).dictionary_encode(),
+        'ensemble': pa.array(glofasDffinal['ensemble'], pa.int16()),
+        'leadTime': pa.array(glofasDffinal['leadTime'].astype(str)).dictionary_encode(),
+        'dis': pa.array(glofasDffinal['dis']),
+    })
+
+
 class GlofasData:
 
-    def __init__(self, leadTimeLabel, leadTimeValue, countryCodeISO3, glofas_stations, district_mapping,admin_df):
+    def __init__(self, leadTimeLabel, leadTimeValue, countryCodeISO3, glofas_stations, district_mapping,admin_df, leadTimes=None):
         #self.db = DatabaseManager(leadTimeLabel, countryCodeISO3)
      
         self.leadTimeLabel = leadTimeLabel
         self.admin_area_gdf=admin_df
         self.leadTimeValue = leadTimeValue
+        # lead times to write station forecasts for, all from the same download and extraction
+        self.leadTimes = leadTimes if leadTimes is not None else {leadTimeLabel: leadTimeValue}
         self.countryCodeISO3 = countryCodeISO3
         self.GLOFAS_FILENAME=SETTINGS[countryCodeISO3]['GLOFAS_FILENAME']
         self.GLOFAS_GRID_FILENAME=GLOFAS_GRID_FILENAME 
@@ -50,8 +135,10 @@ class GlofasData:
         self.TRIGGER_LEVELS=SETTINGS[countryCodeISO3]['TRIGGER_LEVELS']
         self.eapAlertClass=SETTINGS[countryCodeISO3]['eapAlertClass']
         self.selectedPcode = SETTINGS[countryCodeISO3]['selectedPcode']
-        self.inputPath = PIPELINE_DATA+'input/glofas/'
-        self.inputPathGrid = PIPELINE_DATA+'input/glofasgrid/'
+        # downloads are removed before every run, keep them apart per country
+        self.inputPath = PIPELINE_DATA+'input/glofas/' + countryCodeISO3 + '/'
+        self.inputPathGrid = PIPELINE_DATA+'input/glofasgrid/' + countryCodeISO3 + '/'
+        self.glofasGridExtractionPath = self.inputPathGrid + 'glofas_grid_extraction.parquet'
         
         self.glofasAdmnPerDay=PIPELINE_OUTPUT + 'glofas_extraction/glofas_Admin_extraction' + countryCodeISO3 + '.csv'
         
@@ -61,21 +148,27 @@ class GlofasData:
         self.extractedGlofasDir = PIPELINE_OUTPUT + 'glofas_extraction'
         if not os.path.exists(self.extractedGlofasDir):
             os.makedirs(self.extractedGlofasDir)
-        self.extractedGlofasPath = PIPELINE_OUTPUT + \
-            'glofas_extraction/glofas_forecast_' + \
-            self.leadTimeLabel + '_' + countryCodeISO3 + '.json'
+        self.extractedGlofasPath = self.forecastPath(self.leadTimeLabel)
         self.triggersPerStationDir = PIPELINE_OUTPUT + 'triggers_rp_per_station'
         if not os.path.exists(self.triggersPerStationDir):
             os.makedirs(self.triggersPerStationDir)
-        self.triggersPerStationPath = PIPELINE_OUTPUT + \
-            'triggers_rp_per_station/triggers_rp_' + \
-            self.leadTimeLabel + '_' + countryCodeISO3 + '.json'
+        self.triggersPerStationPath = self.triggersPath(self.leadTimeLabel)
         self.GLOFAS_STATIONS = glofas_stations
         self.DISTRICT_MAPPING = district_mapping
         self.current_date = CURRENT_DATE.strftime('%Y%m%d')
         self.placecodeLen= SETTINGS[countryCodeISO3]['placecodeLen'] 
         self.placeCodeInitial= SETTINGS[countryCodeISO3]['placeCodeInitial'] 
 
+    def forecastPath(self, leadTimeLabel):
+        return PIPELINE_OUTPUT + \
+            'glofas_extraction/glofas_forecast_' + \
+            leadTimeLabel + '_' + self.countryCodeISO3 + '.json'
+
+    def triggersPath(self, leadTimeLabel):
+        return PIPELINE_OUTPUT + \
+            'triggers_rp_per_station/triggers_rp_' + \
+            leadTimeLabel + '_' + self.countryCodeISO3 + '.json'
+
     def process(self):
         if SETTINGS[self.countryCodeISO3]['mock'] == True:
             self.extractMockData()
@@ -139,81 +232,80 @@ class GlofasData:
 
     def downloadFtpChunks(self):
         """
-        Download a glofas data from a URL in chunks and save it to a local file.
-        extract data for admin area
-        generate csv files for each admin area
+        Download the glofas ensemble members concurrently, each to its own file,
+        and extract the maximum discharge per admin area in a process pool
+        while the other members are still downloading.
+        The maxima of every member are appended as a row group to one parquet file.
         """
-        # Open a connection to the URL
         bf_gpd=self.admin_area_gdf
   
         bf_gpd['pcode']=bf_gpd['placeCode'].apply(lambda x:int(x[len(self.countryCodeISO3):]))
-        bbox_bfs=list(bf_gpd.total_bounds)
 
-        for ens in range (0,51):
-            ensamble="{:02d}".format(ens)
-            logger.info(f'start downloading data for ensamble {ens}')
-
-
-            url = f'ftp://{GLOFAS_USER}:{GLOFAS_PW}@{GLOFAS_FTP}/fc_netcdf/{self.current_date}/dis_{ensamble}_{self.current_date}00.nc'             
-            chunk_size=8192
-
-            Filename = self.inputPathGrid + 'glofas.nc'
-
-            with urllib.request.urlopen(url) as response:
-                # Open the local file for writing the downloaded content       
-                with open(Filename, 'wb') as out_file:
-                    # Initialize a counter for the downloaded bytes
-                    bytes_downloaded = 0
-
-                    while True:
-                        # Read a chunk from the response
-                        chunk = response.read(chunk_size)
-                        # If the chunk is empty, we have downloaded the entire file
-                        if not chunk:
-                            break
-                        # Write the chunk to the local file
-                        out_file.write(chunk)
-                        # Update the counter
-                        bytes_downloaded += len(chunk)
-                        #print(f"Downloaded {bytes_downloaded} bytes")
-            if out_file:
-                out_file.close()
-            logger.info(f'finished downloading data for ensamble {ens}')
-            nc_file = xr.open_dataset(Filename)  
-            var_data =nc_file.sel(lat=slice(bbox_bfs[3], bbox_bfs[1]),lon=slice(bbox_bfs[0], bbox_bfs[2]))           
-            df_leadtime_ens=[]
-
-            for i in range(0,7):
-                leadTimelabel=str(i+1)+'_day'  
-                nc_p =var_data.sel(time=var_data.time.values[i]).drop(['time']).rio.write_crs("epsg:4326", inplace=True)
-
-                out_grid = make_geocube(
-                    vector_data=bf_gpd,
-                    measurements=['pcode'],
-                    like=nc_p)
-                
-                out_grid=out_grid.rename({'x': 'lon','y': 'lat'})
-                for gof_var in ['dis']:
-                    glofas_rtp=nc_p[gof_var]       
-                    out_grid[gof_var] = (glofas_rtp.dims, glofas_rtp.values)     
-
-                zonal_stats_df = (out_grid.groupby(out_grid['pcode']).max().to_dataframe().reset_index())
-                zonal_stats_df['pcode']=zonal_stats_df['pcode'].apply(lambda x:self.placeCodeInitial + str(int(x)).zfill(self.placecodeLen))
-                zonal_stats_df['ensemble']=ens
-                zonal_stats_df[f'dis_{ensamble}']= zonal_stats_df['dis']
-                
-                zonal_stats_df['leadTime']=leadTimelabel
-                df_leadtime_ens.append(zonal_stats_df.filter(['pcode','ensemble','leadTime','dis','rl2','rl5','rl20']))
+        downloadWorkers = SETTINGS[self.countryCodeISO3].get('GLOFAS_DOWNLOAD_WORKERS', GLOFAS_DOWNLOAD_WORKERS)
+        extractWorkers = SETTINGS[self.countryCodeISO3].get('GLOFAS_EXTRACT_WORKERS', GLOFAS_EXTRACT_WORKERS)
+
+        # members extracted in an earlier (failed) attempt are kept and not downloaded again
+        previous = None
+        if os.path.exists(self.glofasGridExtractionPath):
+            previous = pq.read_table(self.glofasGridExtractionPath)
+        extracted = set(previous.column('ensemble').to_pylist()) if previous is not None else set()
+        ensembles = [ens for ens in range(0,51) if ens not in extracted]
+
+        writer = None
+        try:
+            if previous is not None and previous.num_rows > 0:
+                writer = pq.ParquetWriter(self.glofasGridExtractionPath + '.tmp', previous.schema)
+                writer.write_table(previous)
+            failed = []
+            with ThreadPoolExecutor(max_workers=downloadWorkers) as downloader, \
+                    ProcessPoolExecutor(max_workers=extractWorkers) as extractor:
+                downloads = {downloader.submit(self.downloadEnsemble, ens): ens for ens in ensembles}
+                extractions = {}
+                pending = set(downloads)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in downloads:
+                            ens = downloads[future]
+                            try:
+                                Filename = future.result()
+                            except Exception as exception:
+                                logger.error(f'Download failed for ensamble {ens}: {exception}')
+                                failed.append(ens)
+                                continue
+                            extraction = extractor.submit(extractEnsembleZonalMax, Filename, bf_gpd, ens,
+                                                          self.placeCodeInitial, self.placecodeLen)
+                            extractions[extraction] = ens
+                            pending.add(extraction)
+                        else:
+                            table = glofasGridTable(future.result())
+                            if writer is None:
+                                writer = pq.ParquetWriter(self.glofasGridExtractionPath + '.tmp', table.schema)
+                            writer.write_table(table)
+                            logger.info(f'saved zonal maxima for ensamble {extractions[future]}')
+            if failed:
+                raise ValueError(f'Glofas download failed for ensambles {sorted(failed)}')
+        finally:
+            # keep what was extracted so far, also when a download failed
+            if writer is not None:
+                writer.close()
+                os.replace(self.glofasGridExtractionPath + '.tmp', self.glofasGridExtractionPath)
+        logger.info(f'finished downloading data per chunk')
 
-            glofasDffinal = pd.concat(df_leadtime_ens) 
+    def downloadEnsemble(self, ens):
+        """Download one ensemble member in chunks to its own file and return the local path"""
+        ensamble="{:02d}".format(ens)
+        logger.info(f'start downloading data for ensamble {ens}')
 
-            FilenameCsv = self.inputPathGrid + f'glofas_{ens}.csv'
-            logger.info(f'saved csv files for ensamble {ens}')
+        url = f'ftp://{GLOFAS_USER}:{GLOFAS_PW}@{GLOFAS_FTP}/fc_netcdf/{self.current_date}/dis_{ensamble}_{self.current_date}00.nc'
+        Filename = self.inputPathGrid + f'dis_{ensamble}_{self.current_date}00.nc'
 
-            glofasDffinal.to_csv(FilenameCsv) 
-            #glofasDffinal.to_csv(f'/mnt/containermnt/glofas_{ens}.csv')  
-            nc_file.close()
-        logger.info(f'finished downloading data per chunk')
+        with urllib.request.urlopen(url) as response:
+            with open(Filename + '.part', 'wb') as out_file:
+                shutil.copyfileobj(response, out_file, DOWNLOAD_CHUNK_SIZE)
+        os.replace(Filename + '.part', Filename)
+        logger.info(f'finished downloading data for ensamble {ens}')
+        return Filename
 
 
     def start_download_loop(self):
@@ -283,41 +375,63 @@ class GlofasData:
         #filename ='/mnt/containermnt/glofas.nc'
         Filename = os.path.join(self.inputPathGrid, filename) 
         nc_file = xr.open_dataset(Filename)  
-        var_data =nc_file.sel(lat=slice(bbox_bfs[3], bbox_bfs[1]),lon=slice(bbox_bfs[0], bbox_bfs[2]))           
-        df_leadtime_ens=[]
-
-        for i in range(0,7):
-            leadTimelabel=str(i+1)+'_day'  
-            for ens in range(0,51):
-                nc_p =var_data.sel(time=var_data.time.values[i],ensemble=var_data.ensemble.values[ens]).drop(['time','ensemble']).rio.write_crs("epsg:4326", inplace=True)
-
-                out_grid = make_geocube(
-                    vector_data=bf_gpd,
-                    measurements=['pcode'],
-                    like=nc_p)
-                
-                out_grid=out_grid.rename({'x': 'lon','y': 'lat'})
-                for gof_var in ['dis','rl2','rl5','rl20']:
-                    glofas_rtp=nc_p[gof_var]       
-                    out_grid[gof_var] = (glofas_rtp.dims, glofas_rtp.values)     
-
-                zonal_stats_df = (out_grid.groupby(out_grid['pcode']).max().to_dataframe().reset_index())
-                zonal_stats_df['pcode']=zonal_stats_df['pcode'].apply(lambda x:self.placeCodeInitial + str(int(x)).zfill(self.placecodeLen))
-                zonal_stats_df['ensemble']=ens+1
-                
-                zonal_stats_df['leadTime']=leadTimelabel
-                df_leadtime_ens.append(zonal_stats_df.filter(['pcode','ensemble','leadTime','dis','rl2','rl5','rl20']))
- 
-        glofasDffinal = pd.concat(df_leadtime_ens) 
+        var_data =nc_file.sel(lat=slice(bbox_bfs[3], bbox_bfs[1]),lon=slice(bbox_bfs[0], bbox_bfs[2])).rio.write_crs("epsg:4326")
+        # admin areas are rasterized once for all lead times and ensembles
+        zones = ZonalStats(bf_gpd, var_data.rio.transform(), var_data.rio.shape)
+        pcodes = bf_gpd.drop_duplicates('placeCode').set_index('placeCode')['pcode'].reindex(zones.placeCodes).values
+        ensembles = [ens+1 for ens in range(0,51)]
+
+        if GLOFAS_GRID_STREAMING:
+            # chunks are aligned to the admin window, so only that window is read from the file,
+            # and all lead times and ensembles are reduced in one lazy pass
+            maxima = {}
+            for gof_var in ['dis','rl2','rl5','rl20']:
+                glofas_rtp = var_data[gof_var]
+                if 'time' in glofas_rtp.dims:
+                    glofas_rtp = glofas_rtp.isel(time=slice(0,7))
+                if 'ensemble' in glofas_rtp.dims:
+                    glofas_rtp = glofas_rtp.isel(ensemble=slice(0,51))
+                leadingDims = [dim for dim in ['time','ensemble'] if dim in glofas_rtp.dims]
+                glofas_rtp = glofas_rtp.transpose(*leadingDims, 'lat', 'lon').chunk(
+                    dict({'lat': -1, 'lon': -1}, **{dim: GLOFAS_GRID_CHUNKS[dim] for dim in leadingDims}))
+                values = zones.lazyMax(glofas_rtp.data)
+                if leadingDims == ['ensemble']:
+                    values = values[None, :, :]
+                elif leadingDims == ['time']:
+                    values = values[:, None, :]
+                maxima[gof_var] = values
+            glofasDffinal = zonalMaxToFrame(zones, pcodes, maxima, ensembles, self.placeCodeInitial, self.placecodeLen)
+        else:
+            df_leadtime_ens=[]
+            for i in range(0,7):
+                leadTimelabel=str(i+1)+'_day'  
+                for ens in range(0,51):
+                    nc_p =var_data.isel(time=i,ensemble=ens)
+                    zonal_stats_df = zonalMaxPerPcode(zones, pcodes, nc_p, ['dis','rl2','rl5','rl20'], self.placeCodeInitial, self.placecodeLen)
+                    zonal_stats_df['ensemble']=ensembles[ens]
+                    
+                    zonal_stats_df['leadTime']=leadTimelabel
+                    df_leadtime_ens.append(zonal_stats_df.filter(['pcode','ensemble','leadTime','dis','rl2','rl5','rl20']))
+            glofasDffinal = pd.concat(df_leadtime_ens) 
         
         glofasDffinal.to_csv(self.glofasAdmnPerDay) 
 
         logger.info('Extracted Glofas data from grid- discharge per day File saved') 
             
         nc_file.close()
-        
-        
-          
+
+    def readGlofasGridExtraction(self, pcodes):
+        """Memory map the columns of the zonal maxima written by downloadFtpChunks, for the given pcodes"""
+        table = pq.read_table(self.glofasGridExtractionPath, columns=['pcode', 'leadTime', 'ensemble', 'dis'], memory_map=True)
+        glofasDffinal = table.to_pandas()
+        glofasDffinal = glofasDffinal[glofasDffinal['pcode'].isin(pcodes)]
+        # the discharge as the csv files gave it: written as text and parsed by read_csv, which can
+        # differ from the stored value in the last digit, so the triggers stay the same
+        dis = glofasDffinal['dis'].astype(str)
+        if len(dis):
+            dis = pd.read_csv(io.StringIO('\n'.join(dis)), header=None, names=['dis'], dtype='float64')['dis'].values
+        return glofasDffinal.assign(dis=dis).astype({'pcode': str, 'leadTime': str, 'dis': 'float64'})
+
     def extractGlofasDataGrid(self):
         trigger_per_day = {
             '1-day': False,
@@ -328,84 +442,110 @@ class GlofasData:
             '6-day': False,
             '7-day': False,
         }       
-        #glofasDffinal.to_csv(f'glofas_{ensamble}.csv') 
-
-        csv_files = [f'{self.inputPathGrid}glofas_{f}.csv' for f in range (0,51) ]
-
-        # Create an empty list to hold dataframes
-        dfs = []
-
-        # Read each CSV file into a dataframe and append to the list
-        for csv_file in csv_files:
-            df = pd.read_csv(csv_file)
-            dfs.append(df)
-        # Concatenate all dataframes in the list into a single dataframe
-        glofasDffinal = pd.concat(dfs, ignore_index=True)
-
-        #glofasDffinal= pd.read_csv(self.glofasAdmnPerDay) 
-        selectedPcodeVal=self.selectedPcode
-        #glofasDffinal= glofasDffinal.query('pcode in @selectedPcode')
-        
         df_district_mapping = pd.read_json(json.dumps(self.DISTRICT_MAPPING))
         df_thresholds = pd.read_json(json.dumps(self.GLOFAS_STATIONS))
         df_thresholds = df_thresholds.set_index("stationCode", drop=False)
-        df_district_mapping = df_district_mapping.set_index("glofasStation", drop=False)
-        
-        stations=[]               
-        for exractAdminCode in selectedPcodeVal:
-            station = {}
-            station['code'] = df_district_mapping.query('placeCode == @exractAdminCode')['glofasStation'].values[0]            
-            if station['code'] in df_thresholds['stationCode']:#and station['code'] in df_district_mapping['glofasStation']:
-                logger.info(station['code'])
-                threshold = df_thresholds[df_thresholds['stationCode'] ==station['code']][TRIGGER_LEVEL][0]
-            
-                for step in range(1, 8):
-                    # Loop through 51 ensembles, get forecast and compare to threshold
-                    ensemble_options = 51
-                    count = 0
-                    dis_sum = 0
-                    leadTimelabel=str(step)+'_day'   
-                    
-                    for ensemble in range(0, ensemble_options):
-                        discharge = glofasDffinal.query('pcode in @exractAdminCode').query('ensemble ==@ensemble').query('leadTime ==@leadTimelabel')['dis'].values[0]
-    
-                        if discharge >= threshold:
-                            count = count + 1
-                        dis_sum = dis_sum + discharge                  
-
-                    prob = int(count/ensemble_options)
-                    dis_avg = dis_sum/ensemble_options
-                    
-                    station['fc'] = dis_avg
-                    station['fc_prob'] = prob 
-                    station['fc_trigger'] = 1 if prob > self.TRIGGER_LEVELS['minimum'] else 0
-                    station['eapAlertClass'] = self.checkTriggerProb(prob)
 
-                    if station['fc_trigger'] == 1:
-                        trigger_per_day[str(step)+'-day'] = True
-
-                    if step == self.leadTimeValue:
-                        stations.append(station)
-                    
-        # Add 'no_station'
-        for station_code in ['no_station']:
+        # station and threshold per selected admin area (first match, as before)
+        stationPerPcode = df_district_mapping.drop_duplicates('placeCode').set_index('placeCode')['glofasStation']
+        thresholdPerStation = df_thresholds[~df_thresholds.index.duplicated()][TRIGGER_LEVEL]
+
+        selectedPcodes = []
+        selectedStations = []
+        for exractAdminCode in self.selectedPcode:
+            stationCode = stationPerPcode[exractAdminCode]
+            if stationCode in thresholdPerStation.index:
+                selectedPcodes.append(exractAdminCode)
+                selectedStations.append(stationCode)
+
+        glofasDffinal = self.readGlofasGridExtraction(selectedPcodes)
+
+        ensemble_options = 51
+        leadTimeLabels = [str(step) + '_day' for step in range(1, 8)]
+
+        # pivot once into a (pcode, leadTime, ensemble) cube of discharges
+        cube = glofasDffinal.drop_duplicates(['pcode', 'leadTime', 'ensemble']).set_index(['pcode', 'leadTime', 'ensemble'])['dis']
+        cubeIndex = pd.MultiIndex.from_product([selectedPcodes, leadTimeLabels, range(ensemble_options)])
+        discharge = cube.reindex(cubeIndex).values.reshape(len(selectedPcodes), len(leadTimeLabels), ensemble_options)
+        if np.isnan(discharge).any():
+            raise ValueError('Glofas grid extraction is missing ensemble members for the selected admin areas')
+
+        threshold = thresholdPerStation[selectedStations].values.reshape(-1, 1, 1)
+        count = (discharge >= threshold).sum(axis=2)
+        # cumsum adds the members in order, so the mean is identical to the per-member loop
+        dis_avg = np.cumsum(discharge, axis=2)[:, :, -1] / ensemble_options
+        prob = (count / ensemble_options).astype(int)
+        fc_trigger = prob > self.TRIGGER_LEVELS['minimum']
+
+        for step in range(1, 8):
+            if fc_trigger[:, step - 1].any():
+                trigger_per_day[str(step) + '-day'] = True
+
+        # the station record used to be updated in place until the last lead day
+        lastDayStations = []
+        for i, stationCode in enumerate(selectedStations):
             station = {}
-            station['code'] = station_code
-            station['fc'] = 0
-            station['fc_prob'] = 0
-            station['fc_trigger'] = 0
-            station['eapAlertClass'] = 'no'
-            stations.append(station)
-
-        with open(self.extractedGlofasPath, 'w') as fp:
-            json.dump(stations, fp)
-            logger.info('Extracted Glofas data - File saved_')
-
-        with open(self.triggerPerDay, 'w') as fp:
-            json.dump([trigger_per_day], fp)
-            logger.info('Extracted Glofas data - Trigger per day File saved_')       
+            station['code'] = stationCode
+            station['fc'] = dis_avg[i, -1]
+            station['fc_prob'] = int(prob[i, -1])
+            station['fc_trigger'] = int(fc_trigger[i, -1])
+            station['eapAlertClass'] = self.checkTriggerProb(station['fc_prob'])
+            lastDayStations.append(station)
+
+        for leadTimeLabel, leadTimeValue in self.leadTimes.items():
+            stations = lastDayStations if 1 <= leadTimeValue <= 7 else []
+            self.writeStationForecast(leadTimeLabel, stations)
+
+        ResultBus.publish(self.triggerPerDay, [trigger_per_day])
+        logger.info('Extracted Glofas data - Trigger per day File saved_')       
   
     
+    def loadGlofasPointData(self):
+        """
+        Load the glofas point forecast of the current date merged with the return levels per station.
+        The parsed dataframe is cached as parquet per forecast date (GLOFAS_POINT_CACHE),
+        so a re-run of the same day skips parsing the text files.
+        """
+        cachePath = os.path.join(self.extractedGlofasDir,
+                                 'glofas_point_' + self.countryCodeISO3 + '_' + self.current_date + '.parquet')
+        if GLOFAS_POINT_CACHE and os.path.exists(cachePath):
+            logger.info(f'Loading Glofas point data from cache {cachePath}')
+            return pd.read_parquet(cachePath)
+
+        fileTag = 'RedcrossPhilippines' if self.countryCodeISO3=='PHL' else 'ZambiaRedcross'
+
+        file_path = self.inputPath + 'glofas_discharge_' + fileTag + '_' + self.current_date + '00.txt'
+        df = pd.read_csv(file_path, sep=r'\s+', usecols=['name', 'time', 'member', 'dis'],
+                         dtype={'name': 'category', 'member': 'int16', 'dis': 'float64'},
+                         parse_dates=['time'])
+        df['stationCode'], df['StationName'] = self.splitStationName(df['name'])
+
+        file_path = self.inputPath + 'glofas_returnlevels_ldd_ups_' + fileTag + '_' + self.current_date + '00.txt'
+        # the return level columns the file has, not every country's file has all of them
+        header = pd.read_csv(file_path, sep=r'\s+', nrows=0).columns
+        rpColumns = [col for col in ['lat', 'lon', '2y', '5y', '20y', 'plat', 'plon'] if col in header]
+        dfrp = pd.read_csv(file_path, sep=r'\s+', usecols=['Name'] + rpColumns,
+                           dtype=dict({'Name': 'category'}, **{col: 'float64' for col in rpColumns}))
+        dfrp['stationCode'], dfrp['StationName'] = self.splitStationName(dfrp['Name'])
+
+        dffinal = pd.merge(df, dfrp.filter(['stationCode'] + rpColumns), how='left', on='stationCode')
+        dffinal['stationCode'] = dffinal['stationCode'].astype('category')
+
+        if GLOFAS_POINT_CACHE:
+            for f in os.listdir(self.extractedGlofasDir):
+                if f.startswith('glofas_point_' + self.countryCodeISO3 + '_') and f.endswith('.parquet'):
+                    os.remove(os.path.join(self.extractedGlofasDir, f))
+            dffinal.to_parquet(cachePath + '.tmp')
+            os.replace(cachePath + '.tmp', cachePath)
+        return dffinal
+
+    def splitStationName(self, names):
+        """Split the categorical '<stationCode>_<stationName>' column once per distinct name"""
+        categories = names.cat.categories.str.split('_', n=1)
+        stationCode = pd.Series(pd.Categorical(categories.str[0]).take(names.cat.codes), index=names.index)
+        stationName = pd.Series(pd.Categorical(categories.str[1]).take(names.cat.codes), index=names.index)
+        return stationCode, stationName
+
     def extractGlofasData(self):
         logger.info('\nExtracting Glofas (FTP) Data\n')
 
@@ -416,7 +556,6 @@ class GlofasData:
         df_thresholds = df_thresholds.set_index("stationCode", drop=False)
         df_district_mapping = pd.read_json(json.dumps(self.DISTRICT_MAPPING))
         df_district_mapping = df_district_mapping.set_index("glofasStation", drop=False)
-        stations = []
         trigger_per_day = {
             '1-day': False,
             '2-day': False,
@@ -427,98 +566,51 @@ class GlofasData:
             '7-day': False,
         }
 
-        # read glofas forecst data from a text file
-        #
-        if self.countryCodeISO3=='PHL':
-            file_path= self.inputPath+'glofas_discharge_RedcrossPhilippines_'+ self.current_date+'00.txt'
-            df = pd.read_csv(file_path, sep=r'\s+')  
-            df[['stationCode', 'StationName']] = df['name'].str.split('_', expand=True)[[0,1]]
-            #df.drop(columns=['name'], inplace=True)
-
-            # read return period information from the text file
-
-            file_path=self.inputPath+'glofas_returnlevels_ldd_ups_RedcrossPhilippines_'+ self.current_date+'00.txt'
-            dfrp = pd.read_csv(file_path, sep=r'\s+')
-            dfrp[['stationCode', 'StationName']] = dfrp['Name'].str.split('_', expand=True)[[0,1]]
-
-            dffinal=pd.merge(df.copy(),dfrp.filter(['stationCode','lat','lon','2y','5y','20y','plat','plon']),  how='left',left_on='stationCode' , right_on ='stationCode')
-            dffinal['time'] = pd.to_datetime(df['time'])
-        else:
-            file_path= self.inputPath+'glofas_discharge_ZambiaRedcross_'+ self.current_date+'00.txt'
-            df = pd.read_csv(file_path, sep=r'\s+')  
-            df[['stationCode', 'StationName']] = df['name'].str.split('_', expand=True)[[0,1]]
-            #df.drop(columns=['name'], inplace=True)
-            # read return period information from the text file
-            file_path=self.inputPath+'glofas_returnlevels_ldd_ups_ZambiaRedcross_'+ self.current_date+'00.txt'
-            dfrp = pd.read_csv(file_path, sep=r'\s+')
-            dfrp[['stationCode', 'StationName']] = dfrp['Name'].str.split('_', expand=True)[[0,1]]
-            dffinal=pd.merge(df.copy(),dfrp.filter(['stationCode','lat','lon','2y','5y','20y','plat','plon']),  how='left',left_on='stationCode' , right_on ='stationCode')
-            dffinal['time'] = pd.to_datetime(df['time'])
+        # read glofas forecast and return period information from the text files
+        dffinal = self.loadGlofasPointData()
 
         CURRENT_DATE_v=datetime.datetime.today()
-        dffinal['LeadTime'] = dffinal.apply(lambda row: (row['time']-CURRENT_DATE_v).days,axis=1)
-
-        for StCode in  list(set(df_thresholds.stationCode.values)):
-            # Skip old stations > need to be removed from FTP
-            logger.info(f'processing station: {StCode}')
-            oldStations=['G5230',
-                         'G1724',
-                         'G5196',
-                         'G2001',
-                         'G5670',
-                         'G5694']
-            
-            if StCode in ['no_station']:#oldStations:
-                continue
-                
-
-            station = {}
-            station['code'] = StCode 
-
-            # Get threshold for this specific station
-            if station['code'] in df_district_mapping['glofasStation']:
-                
-              
-                threshold = df_thresholds[df_thresholds['stationCode'] ==station['code']][TRIGGER_LEVEL][0]
-
-                # Set dimension-values
-                time = 0
-
-                for step in range(1, 8):
-
-                    # Loop through 51 ensembles, get forecast and compare to threshold
-      
-                 
-
-                    data = dffinal.query('stationCode==@StCode').query('LeadTime==@step')
-                    if not data.empty:
-                        #logger.info("Data frame not empty continue to process daily forecast ")
-                        data['thresholdCheck'] = data['dis'].apply(lambda x: 1 if x > threshold else 0)       
-                        result= data.agg({'dis' : ['sum', 'count'], 'thresholdCheck' : ['sum', 'count'],'member' : ['sum', 'count']})
-
-                        dis_sum= list(result.dis.values)[0] #result['dis']                  
-                        count= list(result.thresholdCheck.values)[0] #result['thresholdCheck']                  
-                        ensemble_options=list(result.member.values)[1] #result['member']
-                        #logger.info(f'data for processing station: {StCode} {dis_sum} {count} {ensemble_options}')
-                        prob = int(count/ensemble_options)
-                        dis_avg = dis_sum/ensemble_options
-
-                        station['fc'] = dis_avg
-                        station['fc_prob'] = prob 
-                        station['fc_trigger'] = 1 if prob > self.TRIGGER_LEVELS['minimum'] else 0
-                        station['eapAlertClass'] = self.checkTriggerProb(prob) # 1 if prob > self.eapAlertClass['min'] else 0
-
-                        
-                        #station['fc_trigger'] = 1 if prob > TRIGGER_LEVELS['minimum'] else 0
-                        if station['fc_trigger'] == 1:
-                            trigger_per_day[str(step)+'-day'] = True
-
-                        if step == self.leadTimeValue:
-                            stations.append(station)
-
-                    station = {}
-                    station['code'] = StCode
-
+        dffinal['LeadTime'] = (dffinal['time'] - CURRENT_DATE_v).dt.days
+
+        # Threshold per mapped station (first match), skipping 'no_station'
+        thresholds = df_thresholds.reset_index(drop=True).drop_duplicates('stationCode')
+        thresholds = thresholds[(thresholds['stationCode'] != 'no_station') &
+                                (thresholds['stationCode'].isin(df_district_mapping['glofasStation']))]
+        thresholds = thresholds.filter(['stationCode', TRIGGER_LEVEL]).rename(columns={TRIGGER_LEVEL: 'threshold'})
+
+        # One merge and one aggregation over all stations and lead times
+        data = pd.merge(dffinal.filter(['stationCode', 'LeadTime', 'dis', 'member']), thresholds, how='inner', on='stationCode')
+        data = data[data['LeadTime'].isin(range(1, 8))]
+        data['thresholdCheck'] = (data['dis'] > data['threshold']).astype(int)
+        result = data.groupby(['stationCode', 'LeadTime'], observed=True).agg(
+            dis_sum=('dis', 'sum'),
+            count=('thresholdCheck', 'sum'),
+            ensemble_options=('member', 'count')).reset_index()
+
+        result['fc'] = result['dis_sum'] / result['ensemble_options']
+        result['fc_prob'] = (result['count'] / result['ensemble_options']).astype(int)
+        result['fc_trigger'] = (result['fc_prob'] > self.TRIGGER_LEVELS['minimum']).astype(int)
+
+        for step in result.loc[result['fc_trigger'] == 1, 'LeadTime'].unique():
+            trigger_per_day[str(step)+'-day'] = True
+
+        for leadTimeLabel, leadTimeValue in self.leadTimes.items():
+            stations = []
+            for row in result[result['LeadTime'] == leadTimeValue].itertuples():
+                station = {}
+                station['code'] = row.stationCode
+                station['fc'] = float(row.fc)
+                station['fc_prob'] = int(row.fc_prob)
+                station['fc_trigger'] = int(row.fc_trigger)
+                station['eapAlertClass'] = self.checkTriggerProb(station['fc_prob'])
+                stations.append(station)
+            self.writeStationForecast(leadTimeLabel, stations)
+
+        ResultBus.publish(self.triggerPerDay, [trigger_per_day])
+        logger.info('Extracted Glofas data - Trigger per day File saved')
+
+    def writeStationForecast(self, leadTimeLabel, stations):
+        """Write the station forecast of one lead time, with the 'no_station' record added"""
         # Add 'no_station'
         for station_code in ['no_station']:
             station = {}
@@ -527,15 +619,11 @@ class GlofasData:
             station['fc_prob'] = 0
             station['fc_trigger'] = 0
             station['eapAlertClass'] = 'no'
-            stations.append(station)
+            stations = stations + [station]
 
-        with open(self.extractedGlofasPath, 'w') as fp:
+        with open(self.forecastPath(leadTimeLabel), 'w') as fp:
             json.dump(stations, fp)
-            logger.info('Extracted Glofas data - File saved')
-
-        with open(self.triggerPerDay, 'w') as fp:
-            json.dump([trigger_per_day], fp)
-            logger.info('Extracted Glofas data - Trigger per day File saved')
+            logger.info(f'Extracted Glofas data {leadTimeLabel} - File saved')
 
 
     def extractGlofasData_(self):
@@ -639,9 +727,8 @@ class GlofasData:
             json.dump(stations, fp)
             logger.info('Extracted Glofas data - File saved')
 
-        with open(self.triggerPerDay, 'w') as fp:
-            json.dump([trigger_per_day], fp)
-            logger.info('Extracted Glofas data - Trigger per day File saved')
+        ResultBus.publish(self.triggerPerDay, [trigger_per_day])
+        logger.info('Extracted Glofas data - Trigger per day File saved')
 
     def extractMockData(self):
         logger.info('\nExtracting Glofas (mock) Data\n')
@@ -653,7 +740,7 @@ class GlofasData:
         df_district_mapping = df_district_mapping.set_index("glofasStation", drop=False)
 
         # Set up variables to fill
-        stations = []
+        stationsPerStep = {step: [] for step in range(1, 8)}
         trigger_per_day = {
             '1-day': False,
             '2-day': False,
@@ -737,78 +824,39 @@ class GlofasData:
                         trigger_per_day[str(step)+'-day'] = True
                         station['eapAlertClass'] = 'max'
 
-                    if step == self.leadTimeValue:
-                        stations.append(station)
+                    stationsPerStep[step].append(station)
                     station = {}
                     station['code'] = row['stationCode']
 
+        for leadTimeLabel, leadTimeValue in self.leadTimes.items():
+            self.writeStationForecast(leadTimeLabel, stationsPerStep.get(leadTimeValue, []))
 
-        # Add 'no_station'
-        for station_code in ['no_station']:
-            station = {}
-            station['code'] = station_code
-            station['fc'] = 0
-            station['fc_prob'] = 0
-            station['fc_trigger'] = 0
-            station['eapAlertClass'] = 'no'
-            stations.append(station)
-
-        with open(self.extractedGlofasPath, 'w') as fp:
-            json.dump(stations, fp)
-            logger.info('Extracted Glofas data - File saved')
-
-        with open(self.triggerPerDay, 'w') as fp:
-            json.dump([trigger_per_day], fp)
-            logger.info('Extracted Glofas data - Trigger per day File saved')
+        ResultBus.publish(self.triggerPerDay, [trigger_per_day])
+        logger.info('Extracted Glofas data - Trigger per day File saved')
 
     def findTrigger(self):
         # Load (static) threshold values per station
         df_thresholds = pd.read_json(json.dumps(self.GLOFAS_STATIONS))
         df_thresholds = df_thresholds.set_index("stationCode", drop=False)
         df_thresholds.sort_index(inplace=True)
-        # Load extracted Glofas discharge levels per station
-        with open(self.extractedGlofasPath) as json_data:
-            d = json.load(json_data)
-        df_discharge = pd.DataFrame(d)
-        df_discharge.index = df_discharge['code']
-        df_discharge.sort_index(inplace=True)
-
-        # Merge two datasets
-        df = pd.merge(df_thresholds, df_discharge, left_index=True,
-                      right_index=True)
-        del df['lat']
-        del df['lon']
-
-        # Determine trigger + return period per water station
-        for index, row in df.iterrows():
-            fc = float(row['fc'])
-            trigger = int(row['fc_trigger'])
-            if trigger == 1:
-                if (self.countryCodeISO3 == 'ZMB') or (self.countryCodeISO3 == 'MWI'):
-                    if fc >= row['threshold20Year']:
-                        return_period_flood_extent = 20
-                    else:
-                        return_period_flood_extent = 10
-                else:
-                    return_period_flood_extent = 25
-            else:
-                return_period_flood_extent = None
-                
-            if fc >= row['threshold20Year']:
-                return_period = 20
-            elif fc >= row['threshold10Year']:
-                return_period = 10
-            elif fc >= row['threshold5Year']:
-                return_period = 5
-            elif fc >= row['threshold2Year']:
-                return_period = 2
-            else:
-                return_period = None
-            
-            df.at[index, 'fc_rp_flood_extent'] = return_period_flood_extent
-            df.at[index, 'fc_rp'] = return_period
-
-        out = df.to_json(orient='records')
-        with open(self.triggersPerStationPath, 'w') as fp:
-            fp.write(out)
-            logger.info('Processed Glofas data - File saved')
\ No newline at end of file
+        for leadTimeLabel in self.leadTimes:
+            # Load extracted Glofas discharge levels per station
+            with open(self.forecastPath(leadTimeLabel)) as json_data:
+                d = json.load(json_data)
+            df_discharge = pd.DataFrame(d)
+            df_discharge.index = df_discharge['code']
+            df_discharge.sort_index(inplace=True)
+
+            # Merge two datasets
+            df = pd.merge(df_thresholds, df_discharge, left_index=True,
+                          right_index=True)
+            del df['lat']
+            del df['lon']
+
+            # Determine trigger + return period per water station
+            df = classifyReturnPeriods(df, self.countryCodeISO3)
+
+            out = df.to_json(orient='records')
+            # the records as read back from the file, which rounds the floats
+            ResultBus.publish(self.triggersPath(leadTimeLabel), json.loads(out), out)
+            logger.info(f'Processed Glofas data {leadTimeLabel} - File saved')
\ No newline at end of file
@@ -21,6 +21,7 @@ import pysftp
 
 #import cdsapi
 from flood_model.dynamicDataDb import DatabaseManager
+from flood_model.returnPeriods import classifyReturnPeriods
 from flood_model.settings import *
 try:
     from flood_model.secrets import *
@@ -375,33 +376,7 @@ class GlossisData:
         del df['lon']
 
         # Determine trigger + return period per water station
-        for index, row in df.iterrows():
-            fc = float(row['fc'])
-            trigger = int(row['fc_trigger'])
-            if trigger == 1:
-                if self.countryCodeISO3 == 'ZMB':
-                    if fc >= row['threshold20Year']:
-                        return_period_flood_extent = 20
-                    else:
-                        return_period_flood_extent = 10
-                else:
-                    return_period_flood_extent = 25
-            else:
-                return_period_flood_extent = None
-                
-            if fc >= row['threshold20Year']:
-                return_period = 20
-            elif fc >= row['threshold10Year']:
-                return_period = 10
-            elif fc >= row['threshold5Year']:
-                return_period = 5
-            elif fc >= row['threshold2Year']:
-                return_period = 2
-            else:
-                return_period = None
-            
-            df.at[index, 'fc_rp_flood_extent'] = return_period_flood_extent
-            df.at[index, 'fc_rp'] = return_period
+        df = classifyReturnPeriods(df, self.countryCodeISO3)
 
         out = df.to_json(orient='records')
         with open(self.triggersPerStationPath, 'w') as fp:
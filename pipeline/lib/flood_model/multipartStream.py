@@ -0,0 +1,76 @@
+import os
+import binascii
+
+
+class MultipartStream:
+
+    """
+    multipart/form-data body with one file, read from disk in chunks while the request is sent,
+    so the file is never held in memory. The body has a known length (Content-Length) and can be
+    rewound to send it again.
+    """
+
+    def __init__(self, fieldName, path, filename=None, chunkSize=1024 * 1024):
+        boundary = binascii.hexlify(os.urandom(16)).decode()
+        self.path = path
+        self.filename = filename or os.path.basename(path)
+        self.contentType = 'multipart/form-data; boundary=' + boundary
+        self.head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{fieldName}"; '
+                     f'filename="{self.filename}"\r\n\r\n').encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.fileSize = os.path.getsize(path)
+        self.file = open(path, 'rb')
+        self.chunkSize = chunkSize
+        self.position = 0
+
+    def __len__(self):
+        return len(self.head) + self.fileSize + len(self.tail)
+
+    def __iter__(self):
+        chunk = self.read(self.chunkSize)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunkSize)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self.position
+        chunks = []
+        while size > 0 and self.position < len(self):
+            fileStart = len(self.head)
+            fileEnd = fileStart + self.fileSize
+            if self.position < fileStart:
+                chunk = self.head[self.position:self.position + size]
+            elif self.position < fileEnd:
+                chunk = self.file.read(min(size, fileEnd - self.position))
+                if not chunk:
+                    raise IOError(f'{self.file.name} changed during the upload')
+            else:
+                chunk = self.tail[self.position - fileEnd:self.position - fileEnd + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Rewind the body (only seeking to the start or the end is supported)"""
+        if whence == os.SEEK_END and offset == 0:
+            self.position = len(self)
+        elif whence == os.SEEK_SET and offset == 0:
+            self.position = 0
+            self.file.seek(0)
+        else:
+            raise ValueError('MultipartStream can only seek to its start or end')
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
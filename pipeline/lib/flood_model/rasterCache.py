@@ -0,0 +1,55 @@
+import os
+from collections import OrderedDict
+import rasterio
+from flood_model.settings import *
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RasterCache:
+
+    """
+    Least recently used cache of raster datasets opened for reading, shared by the
+    flood extent and exposure calculations of a process, so headers and the GDAL
+    block cache of the input rasters are reused. Entries are keyed by path and
+    modification time: a raster that is rewritten is opened again.
+    Datasets from the cache are closed by the cache, not by the caller.
+    """
+
+    datasets = OrderedDict()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def open(cls, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise rasterio.errors.RasterioIOError(f'{path}: No such file or directory')
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        if key in cls.datasets:
+            cls.hits += 1
+            cls.datasets.move_to_end(key)
+            return cls.datasets[key]
+
+        cls.misses += 1
+        cls.release(path)
+        dataset = rasterio.open(path)
+        cls.datasets[key] = dataset
+        while len(cls.datasets) > RASTER_CACHE_SIZE:
+            cls.datasets.popitem(last=False)[1].close()
+        return dataset
+
+    @classmethod
+    def release(cls, path):
+        """Close the cached datasets of a path, e.g. before the file is written"""
+        path = os.path.abspath(path)
+        for key in [key for key in cls.datasets if key[0] == path]:
+            cls.datasets.pop(key).close()
+
+    @classmethod
+    def logStats(cls, stage):
+        """Log and reset the hit and miss counters of a pipeline stage"""
+        logger.info(f'Raster cache {stage}: {cls.hits} hits, {cls.misses} misses, {len(cls.datasets)} datasets open')
+        cls.hits = 0
+        cls.misses = 0
@@ -0,0 +1,23 @@
+import sys
+import logging
+from flood_model.settings import *
+from flood_model.dynamicDataDb import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """
+    Replay the uploads to the IBF API that are pending in the spool (see UploadSpool), of the
+    countries given as arguments or of all countries. Run it from the folder the pipeline runs in,
+    when the pipeline is not running. Exits with 1 if uploads are still pending.
+    """
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+    countryCodes = sys.argv[1:] or None
+    result = DatabaseManager.replayUploads(countryCodes)
+    logger.info(f"Replayed {result['replayed']} uploads, {result['pending']} pending")
+    sys.exit(1 if result['pending'] else 0)
+
+
+if __name__ == "__main__":
+    main()
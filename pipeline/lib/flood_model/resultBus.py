@@ -0,0 +1,65 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flood_model.settings import *
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ResultBus:
+
+    """
+    Results of the compute stages of a process (triggers, exposure) handed to the next stages and
+    the upload in memory, keyed by the path of their output file. The files are a side output,
+    written in a background thread if RESULT_FILES is set; flush() waits until they are written.
+    A result that was not published in this process is read from its file.
+    """
+
+    results = {}
+    lock = threading.Lock()
+    writer = None
+    pendingWrites = []
+
+    @classmethod
+    def publish(cls, path, payload, content=None):
+        """
+        Publish the payload of a result file. The file is written with content (text, or a function
+        returning it, run in the background thread) if given, else with the payload as json.
+        """
+        with cls.lock:
+            cls.results[os.path.abspath(path)] = payload
+            if not RESULT_FILES:
+                return
+            if cls.writer is None:
+                # one thread, so the files are written in the order they are published
+                cls.writer = ThreadPoolExecutor(max_workers=1)
+            cls.pendingWrites.append(cls.writer.submit(cls.writeFile, path, payload, content))
+
+    @staticmethod
+    def writeFile(path, payload, content):
+        if callable(content):
+            content = content()
+        elif content is None:
+            content = json.dumps(payload)
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+    @classmethod
+    def load(cls, path):
+        """Payload of a result file: as published in this process, else read from the file (json)"""
+        with cls.lock:
+            if os.path.abspath(path) in cls.results:
+                return cls.results[os.path.abspath(path)]
+        with open(path) as fp:
+            return json.load(fp)
+
+    @classmethod
+    def flush(cls):
+        """Wait until the published files are written, raises the first error writing them"""
+        with cls.lock:
+            pendingWrites, cls.pendingWrites = cls.pendingWrites, []
+        errors = [future.exception() for future in pendingWrites if future.exception() is not None]
+        if errors:
+            logger.error(f'{len(errors)} result files could not be written')
+            raise errors[0]
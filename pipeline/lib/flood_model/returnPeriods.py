@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from flood_model.settings import *
+import logging
+logger = logging.getLogger(__name__)
+
+
+def highestReturnPeriod(df, fc, returnPeriods):
+    """
+    Highest of returnPeriods whose threshold<rp>Year column in df is reached by the
+    forecast fc (one value per row), NaN where none is reached.
+    """
+    returnPeriods = sorted(returnPeriods)
+    if len(returnPeriods) == 0:
+        return np.full(len(df), np.nan)
+    thresholds = df[['threshold' + str(rp) + 'Year' for rp in returnPeriods]].to_numpy(dtype=float)
+    reached = fc[:, None] >= thresholds
+    # first reached column counting down from the highest return period
+    highest = len(returnPeriods) - 1 - np.argmax(reached[:, ::-1], axis=1)
+    return np.where(reached.any(axis=1), np.array(returnPeriods, dtype=float)[highest], np.nan)
+
+
+def classifyReturnPeriods(df, countryCodeISO3):
+    """
+    Add the forecast return period (fc_rp) and the return period of the flood extent map
+    to use (fc_rp_flood_extent, triggered stations only) to the stations in df, which
+    needs the columns fc, fc_trigger and threshold<rp>Year for the configured return periods.
+    Both are integers (Int64), empty where there is none, so the triggers json has 10, not 10.0.
+    """
+    countrySettings = SETTINGS.get(countryCodeISO3, {})
+    returnPeriods = countrySettings.get('RETURN_PERIODS', RETURN_PERIODS)
+    extentReturnPeriods = sorted(countrySettings.get('FLOOD_EXTENT_RETURN_PERIODS', FLOOD_EXTENT_RETURN_PERIODS))
+
+    fc = df['fc'].to_numpy(dtype=float)
+    triggered = df['fc_trigger'].to_numpy(dtype=int) == 1
+
+    # the lowest flood extent map needs no threshold, it is the fallback for any triggered station
+    floodExtent = highestReturnPeriod(df, fc, extentReturnPeriods[1:])
+    floodExtent = np.where(np.isnan(floodExtent), extentReturnPeriods[0], floodExtent)
+
+    df['fc_rp_flood_extent'] = pd.Series(np.where(triggered, floodExtent, np.nan), index=df.index).astype('Int64')
+    df['fc_rp'] = pd.Series(highestReturnPeriod(df, fc, returnPeriods), index=df.index).astype('Int64')
+    return df
@@ -9,10 +9,15 @@ try:
 except ImportError:
     print('No secrets file found.')
 from flood_model.exposure import Exposure 
+from flood_model.apiClient import ApiClient
+from flood_model.resultBus import ResultBus
+from flood_model.uploadSpool import UploadSpool
 import resource
 import os
 import logging
 import zipfile
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from flood_model.googledrivedata import downloaddatalack 
 
             
@@ -33,6 +38,20 @@ logger = logging.getLogger(__name__)
 
 logger.info(f"{IBF_URL},{ADMIN_LOGIN},{IBF_PASSWORD}") 
 
+def processLeadTime(fc, COUNTRY_CODE):
+    fc.floodExtent.calculate()
+    logger.info('--------Finished flood extent')
+    fc.exposure.callAllExposure()
+    logger.info('--------Finished exposure')
+    if COUNTRY_CODE =='SSD':
+        fc.exposure.makeMaps()
+        logger.info('--------Finished make maps')                
+    fc.db.upload()                
+    logger.info('--------Finished upload')
+    fc.db.sendNotification()
+    logger.info('--------Finished notification')
+
+
 def main():
     startTime = time.time() 
     logger.info(str(datetime.datetime.now()))
@@ -60,33 +79,77 @@ def main():
     logger.info(str(datetime.datetime.now()))
 
 
-    try:
+    summary = []
+    workers = min(COUNTRY_WORKERS, len(COUNTRY_CODES))
+    if workers > 1:
+        # every country runs in its own process, so a failure or crash only stops that country
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(runCountry, COUNTRY_CODE): COUNTRY_CODE for COUNTRY_CODE in COUNTRY_CODES}
+            for future in as_completed(futures):
+                try:
+                    summary.append(future.result())
+                except Exception as e:
+                    summary.append({'country': futures[future], 'status': 'failed', 'error': str(e),
+                                    'pendingUploads': None, 'seconds': None})
+    else:
         for COUNTRY_CODE in COUNTRY_CODES:
-            logger.info(f'--------STARTING: {COUNTRY_CODE}' + '--------------------------')
-            COUNTRY_SETTINGS = SETTINGS[COUNTRY_CODE]
-            LEAD_TIMES = COUNTRY_SETTINGS['lead_times']
+            summary.append(runCountry(COUNTRY_CODE))
+
+    writeSummary(summary)
+    elapsedTime = str(time.time() - startTime)
+    logger.info(str(elapsedTime))
+
 
+def runCountry(COUNTRY_CODE):
+    """Run the pipeline of one country, returns its status and wall time for the run summary"""
+    countryStartTime = time.time()
+    result = {'country': COUNTRY_CODE, 'status': 'success', 'error': None}
+    try:
+        logger.info(f'--------STARTING: {COUNTRY_CODE}' + '--------------------------')
+        COUNTRY_SETTINGS = SETTINGS[COUNTRY_CODE]
+        LEAD_TIMES = COUNTRY_SETTINGS['lead_times']
+
+        if MULTI_LEAD_TIME_FORECAST:
+            # parse the inputs and process the glofas data once for all lead times
+            leadTimeLabel, leadTimeValue = next(iter(LEAD_TIMES.items()))
+            fc = Forecast(leadTimeLabel, leadTimeValue, COUNTRY_CODE,COUNTRY_SETTINGS['admin_level'], LEAD_TIMES)
+            fc.glofasData.process()
+            logger.info('--------Finished GLOFAS data Processing')
+            for leadTimeLabel, leadTimeValue in LEAD_TIMES.items():
+                logger.info(f'--------STARTING: {leadTimeLabel}' + '--------------------------')
+                fc.setLeadTime(leadTimeLabel, leadTimeValue)
+                processLeadTime(fc, COUNTRY_CODE)
+        else:
             for leadTimeLabel, leadTimeValue in LEAD_TIMES.items():
                 logger.info(f'--------STARTING: {leadTimeLabel}' + '--------------------------')
                 fc = Forecast(leadTimeLabel, leadTimeValue, COUNTRY_CODE,COUNTRY_SETTINGS['admin_level'])
                 fc.glofasData.process()
                 logger.info('--------Finished GLOFAS data Processing')
-                fc.floodExtent.calculate()
-                logger.info('--------Finished flood extent')
-                fc.exposure.callAllExposure()
-                logger.info('--------Finished exposure')
-                if COUNTRY_CODE =='SSD':
-                    fc.exposure.makeMaps()
-                    logger.info('--------Finished make maps')                
-                fc.db.upload()                
-                logger.info('--------Finished upload')
-                fc.db.sendNotification()
-                logger.info('--------Finished notification')
+                processLeadTime(fc, COUNTRY_CODE)
+        ResultBus.flush()
+        ApiClient.logStats()
     except Exception as e:
-        logger.error("Flood Data PIPELINE ERROR")
+        logger.error(f"Flood Data PIPELINE ERROR {COUNTRY_CODE}")
         logger.error(e)
-    elapsedTime = str(time.time() - startTime)
-    logger.info(str(elapsedTime))
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    # uploads that failed are kept in the spool, to be replayed (replay-flood-uploads) without running again
+    result['pendingUploads'] = UploadSpool().count([COUNTRY_CODE])
+    result['seconds'] = round(time.time() - countryStartTime, 1)
+    return result
+
+
+def writeSummary(summary):
+    """Log the status and wall time per country and save them to PIPELINE_SUMMARY"""
+    summary = sorted(summary, key=lambda x: COUNTRY_CODES.index(x['country']))
+    for result in summary:
+        logger.info(f"{result['country']}: {result['status']} in {result['seconds']} s" +
+                    (f" ({result['error']})" if result['error'] else '') +
+                    (f", {result['pendingUploads']} uploads pending" if result['pendingUploads'] else ''))
+    if not os.path.exists(os.path.dirname(PIPELINE_SUMMARY)):
+        os.makedirs(os.path.dirname(PIPELINE_SUMMARY))
+    with open(PIPELINE_SUMMARY, 'w') as fp:
+        json.dump({'date': str(datetime.datetime.now()), 'countries': summary}, fp, indent=2)
 
 
 if __name__ == "__main__":
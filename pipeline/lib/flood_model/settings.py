@@ -125,6 +125,7 @@ SETTINGS = {
         },
         'TRIGGER_LEVELS':{"minimum": 0.6,"medium": 0.7,"maximum": 0.8},
         'eapAlertClass':{"no": 0.6,"min": 0.7,"med": 0.8,"max": 0.801},
+        'FLOOD_EXTENT_RETURN_PERIODS': [10, 20],
         'admin_level': 3,
         'levels':[3,2,1],
         'GLOFAS_FTP':'aux.ecmwf.int/for_ZambiaRedcross/',
@@ -155,6 +156,69 @@ CURRENT_DATE = date.today()
 GOOGLE_DRIVE_DATA_URL = 'https://drive.google.com/file/d/14MbG4uFPGJCduM5aLkvgSGqA8io6Gh9C/view?usp=sharing'
 
 
+# Number of countries run concurrently, each in its own worker process
+COUNTRY_WORKERS = 4
+
+# Parse the inputs and process the GloFAS forecast once per country for all its lead times,
+# instead of building a new Forecast per lead time
+MULTI_LEAD_TIME_FORECAST = True
+
+# Cache the parsed GloFAS point forecast as parquet, so re-runs of the same forecast date skip parsing
+GLOFAS_POINT_CACHE = True
+
+# Concurrency of the GloFAS grid download (SSD), can be overridden per country in SETTINGS
+GLOFAS_DOWNLOAD_WORKERS = 4
+GLOFAS_EXTRACT_WORKERS = 2
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Read the GloFAS grid lazily (dask) in chunks aligned to the admin window, to bound memory
+GLOFAS_GRID_STREAMING = True
+GLOFAS_GRID_CHUNKS = {'time': 1, 'ensemble': 17}
+
+# Return periods with a threshold<rp>Year level per station, used to classify the forecast discharge
+RETURN_PERIODS = [2, 5, 10, 20]
+# Return periods of the available flood extent maps: a triggered station gets the highest one whose
+# threshold<rp>Year is reached, else the lowest. Both can be overridden per country in SETTINGS, for
+# the GloFAS and the GLOSSIS triggers alike. Countries with 10 and 20 year maps (ZMB, MWI) set [10, 20]
+FLOOD_EXTENT_RETURN_PERIODS = [25]
+
+# Cells per side of the windows, aligned to the raster's internal blocks, in which exposure rasters are
+# processed. In streaming mode the sums per admin area are also accumulated per window, instead of
+# from a label grid of the whole raster. Streaming can be enabled per country in SETTINGS
+RASTER_WINDOW_SIZE = 1024
+EXPOSURE_STREAMING = False
+
+# Raster datasets kept open for reading per process (see RasterCache)
+RASTER_CACHE_SIZE = 16
+
+# Label grids of the admin areas kept in memory per process, next to their cache on disk (see ZonalStats)
+ZONE_LABELS_CACHE_SIZE = 4
+
+# Write the triggers and exposure results to their json/csv files (in a background thread), next to
+# handing them to the upload in memory (see ResultBus)
+RESULT_FILES = True
+
+# Keep-alive connections per host of the IBF API client, and the seconds before the expiry of the
+# login token at which it is renewed (see ApiClient)
+API_POOL_SIZE = 10
+API_TOKEN_REFRESH_MARGIN = 60
+
+# Concurrent uploads of the exposure per admin level and indicator (can be overridden per country in
+# SETTINGS), and the retries of an upload on a server error, after API_UPLOAD_BACKOFF, 2x, 4x.. seconds
+API_UPLOAD_WORKERS = 4
+API_UPLOAD_RETRIES = 3
+API_UPLOAD_BACKOFF = 1
+
+# Upload the flood extent as a Cloud Optimized GeoTIFF (tiled, with overviews), can be enabled per
+# country in SETTINGS
+RASTER_UPLOAD_COG = False
+RASTER_UPLOAD_COG_COMPRESS = 'DEFLATE'
+
+# Queues (country and lead time) of the upload spool replayed concurrently, and the attempts after
+# which a failing upload is no longer replayed (see UploadSpool)
+UPLOAD_REPLAY_WORKERS = 4
+UPLOAD_SPOOL_MAX_ATTEMPTS = 5
+
 # Trigger probability 
 TRIGGER_LEVELS = {
     "minimum": 0.6,
@@ -172,6 +236,11 @@ RASTER_OUTPUT = RASTER_DATA + 'output/'
 PIPELINE_DATA = 'data/other/'
 PIPELINE_INPUT = PIPELINE_DATA + 'input/'
 PIPELINE_OUTPUT = PIPELINE_DATA + 'output/'
+ZONE_LABELS_CACHE = PIPELINE_OUTPUT + 'zone_labels/'
+FLOOD_EXTENT_CACHE = PIPELINE_OUTPUT + 'flood_extent_cache/'
+EXPOSURE_CACHE = PIPELINE_OUTPUT + 'exposure_cache/'
+PIPELINE_SUMMARY = PIPELINE_OUTPUT + 'pipeline_summary.json'
+UPLOAD_SPOOL = PIPELINE_OUTPUT + 'upload_spool/'
 TRIGGER_DATA_FOLDER='data/trigger_data/triggers_rp_per_station/'
 TRIGGER_DATA_FOLDER_TR='data/trigger_data/glofas_trigger_levels/'
 STATION_DISTRICT_MAPPING_FOLDER='data/trigger_data/station_district_mapping/'
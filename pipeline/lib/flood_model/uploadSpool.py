@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from flood_model.settings import *
+import logging
+logger = logging.getLogger(__name__)
+
+
+class UploadSpool:
+
+    """
+    Durable spool (SQLite, in UPLOAD_SPOOL) of the uploads to the IBF API. An upload is recorded
+    before it is sent and removed once the API accepted it, so an upload that failed, or was cut
+    off by a crash, is kept with its body or file and can be replayed without running the pipeline
+    again. The uploads of a country and lead time form a queue, replayed in the order they were
+    recorded. A new upload of the same data (path, indicator and admin level) replaces a pending
+    one. Uploads the API rejected (4xx), or that failed UPLOAD_SPOOL_MAX_ATTEMPTS times (dead), are
+    kept for inspection, but not replayed.
+    """
+
+    runs = {}
+
+    def __init__(self, folder=UPLOAD_SPOOL):
+        self.folder = folder
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.path = os.path.join(self.folder, 'uploads.sqlite')
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                countryCodeISO3 TEXT, leadTime TEXT, path TEXT, body TEXT, filePath TEXT, fileName TEXT,
+                status TEXT, runId TEXT, created REAL, attempts INTEGER DEFAULT 0, lastError TEXT, uploadKey TEXT)''')
+            if 'uploadKey' not in [column['name'] for column in db.execute('PRAGMA table_info(uploads)')]:
+                db.execute('ALTER TABLE uploads ADD COLUMN uploadKey TEXT')
+
+    @contextmanager
+    def connect(self):
+        # one connection per operation, so the spool can be used from threads and processes
+        db = sqlite3.connect(self.path, timeout=60)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @classmethod
+    def runId(cls):
+        """Id of this process' run, to tell uploads it is sending from ones left by an earlier run"""
+        if os.getpid() not in cls.runs:
+            cls.runs[os.getpid()] = uuid.uuid4().hex
+        return cls.runs[os.getpid()]
+
+    @staticmethod
+    def uploadKey(path, body=None):
+        """Key of the data of an upload: the path, and the indicator and admin level of exposure"""
+        return path + ''.join(f'/{body[key]}' for key in ['dynamicIndicator', 'adminLevel']
+                              if body is not None and key in body)
+
+    def add(self, countryCodeISO3, leadTime, path, body=None, stream=None):
+        """Record an upload that is about to be sent, replacing pending uploads of the same data, returns its id"""
+        uploadKey = self.uploadKey(path, body)
+        where, params = self.pendingFilter([countryCodeISO3])
+        with self.connect() as db:
+            replaced = db.execute(f'SELECT id, filePath FROM uploads WHERE {where} AND leadTime = ? AND uploadKey = ?',
+                                  params + [leadTime, uploadKey]).fetchall()
+            db.executemany('DELETE FROM uploads WHERE id = ?', [(upload['id'],) for upload in replaced])
+            cursor = db.execute(
+                'INSERT INTO uploads (countryCodeISO3, leadTime, path, body, filePath, fileName, status, runId, created, uploadKey) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (countryCodeISO3, leadTime, path, json.dumps(body) if body is not None else None,
+                 stream.path if stream is not None else None, stream.filename if stream is not None else None,
+                 'sending', self.runId(), time.time(), uploadKey))
+        for upload in replaced:
+            self.removeFile(upload['filePath'])
+        if replaced:
+            logger.info(f'Upload to {uploadKey} replaces {len(replaced)} pending uploads')
+        return cursor.lastrowid
+
+    def isBlocked(self, uploadId):
+        """
+        If earlier uploads of the queue of an upload failed in this run, so it has to wait for them.
+        Pending uploads of earlier runs do not block it, they are replayed (or replaced) separately.
+        """
+        with self.connect() as db:
+            return db.execute(
+                'SELECT 1 FROM uploads AS u JOIN uploads AS e ON e.countryCodeISO3 = u.countryCodeISO3 '
+                'AND e.leadTime = u.leadTime AND e.id < u.id WHERE u.id = ? '
+                "AND e.status = 'pending' AND e.runId = ? LIMIT 1",
+                (uploadId, self.runId())).fetchone() is not None
+
+    def keep(self, uploadId, error, rejected=False, attempted=True):
+        """
+        Keep a failed upload as pending, or as rejected, or as dead once it was attempted
+        UPLOAD_SPOOL_MAX_ATTEMPTS times; returns that status. Its file is copied into the spool,
+        as the pipeline overwrites it on the next run.
+        """
+        with self.connect() as db:
+            upload = db.execute('SELECT * FROM uploads WHERE id = ?', (uploadId,)).fetchone()
+            filePath = upload['filePath']
+            if filePath is not None and os.path.exists(filePath) and \
+                    os.path.dirname(os.path.abspath(filePath)) != os.path.abspath(self.folder):
+                filePath = os.path.join(self.folder, f"{uploadId}_{upload['fileName']}")
+                shutil.copyfile(upload['filePath'], filePath)
+            attempts = upload['attempts'] + (1 if attempted else 0)
+            if rejected:
+                status = 'rejected'
+            elif attempts >= UPLOAD_SPOOL_MAX_ATTEMPTS:
+                status = 'dead'
+            else:
+                status = 'pending'
+            db.execute('UPDATE uploads SET status = ?, filePath = ?, attempts = ?, lastError = ? WHERE id = ?',
+                       (status, filePath, attempts, str(error), uploadId))
+        if status == 'dead':
+            logger.error(f"Upload {uploadId} to {upload['path']} failed {attempts} times, it is not replayed anymore")
+        return status
+
+    def remove(self, uploadId):
+        """Remove an upload the API accepted, with its file if it was copied into the spool"""
+        with self.connect() as db:
+            upload = db.execute('SELECT filePath FROM uploads WHERE id = ?', (uploadId,)).fetchone()
+            db.execute('DELETE FROM uploads WHERE id = ?', (uploadId,))
+        if upload is not None:
+            self.removeFile(upload['filePath'])
+
+    def removeFile(self, filePath):
+        """Remove the file of an upload if it was copied into the spool"""
+        if filePath is not None and os.path.dirname(os.path.abspath(filePath)) == os.path.abspath(self.folder) \
+                and os.path.exists(filePath):
+            os.remove(filePath)
+
+    def pendingFilter(self, countryCodes=None):
+        # uploads left 'sending' by an earlier run were cut off, so they are pending too
+        where = "(status = 'pending' OR (status = 'sending' AND runId != ?))"
+        params = [self.runId()]
+        if countryCodes:
+            where += f" AND countryCodeISO3 IN ({', '.join('?' * len(countryCodes))})"
+            params += list(countryCodes)
+        return where, params
+
+    def queues(self, countryCodes=None):
+        """(country, lead time) of the queues with pending uploads"""
+        where, params = self.pendingFilter(countryCodes)
+        with self.connect() as db:
+            return [(row['countryCodeISO3'], row['leadTime']) for row in db.execute(
+                f'SELECT countryCodeISO3, leadTime FROM uploads WHERE {where} '
+                f'GROUP BY countryCodeISO3, leadTime ORDER BY MIN(id)', params)]
+
+    def pending(self, countryCodeISO3, leadTime):
+        """Pending uploads of a queue, in the order they were recorded"""
+        where, params = self.pendingFilter([countryCodeISO3])
+        with self.connect() as db:
+            return [dict(row) for row in db.execute(
+                f'SELECT * FROM uploads WHERE {where} AND leadTime = ? ORDER BY id', params + [leadTime])]
+
+    def count(self, countryCodes=None, run=False):
+        """Number of pending uploads, of this run only if run is set"""
+        where, params = self.pendingFilter(countryCodes)
+        if run:
+            where += ' AND runId = ?'
+            params.append(self.runId())
+        with self.connect() as db:
+            return db.execute(f'SELECT COUNT(*) FROM uploads WHERE {where}', params).fetchone()[0]
@@ -0,0 +1,177 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import rasterio.features
+import rasterio.windows
+import rasterio.transform
+from shapely.geometry import box
+from flood_model.settings import *
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ZonalStats:
+
+    """
+    Class used to calculate statistics per admin area on a raster grid.
+    The admin areas are rasterized once to a grid of zone labels (0 outside any area,
+    i+1 for the i-th placeCode), which is cached on disk keyed by the grid transform, shape
+    and a hash of the admin boundaries, and in memory for the ZONE_LABELS_CACHE_SIZE grids
+    used most recently. Every reduction is then one
+    pass over the labels instead of a clip or rasterization per area.
+    """
+
+    labelCache = OrderedDict()
+
+    def __init__(self, admin_gdf, transform, shape, cacheDir=ZONE_LABELS_CACHE):
+        codes, placeCodes = pd.factorize(admin_gdf['placeCode'])
+        self.placeCodes = list(placeCodes)
+        self.nZones = len(self.placeCodes)
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.cacheDir = cacheDir
+        self.key = self.gridKey(admin_gdf, transform, shape)
+        self.labels = self.loadLabels(admin_gdf, codes)
+        self.count = np.bincount(self.labels.ravel(), minlength=self.nZones + 1)[1:]
+        self.order = None
+
+    def sortCells(self):
+        """Sort the cells inside any area by label once, so a reduction is a reduceat over contiguous runs"""
+        if self.order is None:
+            flat = self.labels.ravel()
+            inside = np.flatnonzero(flat)
+            order = inside[np.argsort(flat[inside], kind='stable')]
+            zoneLabels, self.starts = np.unique(flat[order], return_index=True)
+            self.zones = zoneLabels - 1
+            self.order = order
+
+    @staticmethod
+    def gridKey(admin_gdf, transform, shape):
+        """Key of the label grid: hash of the grid transform and shape, and of the admin boundaries"""
+        boundaryHash = hashlib.sha1()
+        boundaryHash.update(str(admin_gdf.crs).encode())
+        for placeCode, geom in zip(admin_gdf['placeCode'], admin_gdf.geometry):
+            boundaryHash.update(str(placeCode).encode())
+            boundaryHash.update(geom.wkb)
+        gridHash = hashlib.sha1(repr((tuple(transform)[:6], tuple(shape))).encode())
+        return gridHash.hexdigest()[:16] + '_' + boundaryHash.hexdigest()[:16]
+
+    def loadLabels(self, admin_gdf, codes):
+        if self.key in ZonalStats.labelCache:
+            ZonalStats.labelCache.move_to_end(self.key)
+            return ZonalStats.labelCache[self.key]
+
+        cachePath = os.path.join(self.cacheDir, 'zone_labels_' + self.key + '.npy')
+        if os.path.exists(cachePath):
+            labels = np.load(cachePath)
+        else:
+            logger.info(f'Rasterizing {self.nZones} admin areas onto a {self.shape} grid')
+            labels = rasterio.features.rasterize(
+                ((geom, code + 1) for geom, code in zip(admin_gdf.geometry, codes) if geom is not None),
+                out_shape=self.shape,
+                transform=self.transform,
+                fill=0,
+                dtype='uint16' if self.nZones < np.iinfo(np.uint16).max else 'int32')
+            if not os.path.exists(self.cacheDir):
+                os.makedirs(self.cacheDir, exist_ok=True)
+            # write to a temporary file first, other processes may read the cache concurrently
+            tmpPath = cachePath + f'.{os.getpid()}.tmp'
+            with open(tmpPath, 'wb') as fp:
+                np.save(fp, labels)
+            os.replace(tmpPath, cachePath)
+        ZonalStats.labelCache[self.key] = labels
+        while len(ZonalStats.labelCache) > ZONE_LABELS_CACHE_SIZE:
+            ZonalStats.labelCache.popitem(last=False)
+        return labels
+
+    def max(self, values):
+        """Maximum of values per zone, ignoring NaN; NaN for zones without cells"""
+        result = np.full(self.nZones, np.nan, dtype=np.result_type(values.dtype, np.float32))
+        self.sortCells()
+        if len(self.order) > 0:
+            result[self.zones] = np.fmax.reduceat(values.ravel()[self.order], self.starts)
+        return result
+
+    def lazyMax(self, data):
+        """
+        Maximum per zone over the two trailing (y, x) axes of a dask array, for every
+        index of the leading axes (e.g. time and ensemble). The reduction runs block by
+        block, so only one block of the grid window is held in memory per thread.
+        """
+        data = data.rechunk({data.ndim - 2: -1, data.ndim - 1: -1})
+        self.sortCells()
+        nCells = data.shape[-2] * data.shape[-1]
+
+        def blockMax(block):
+            flat = block.reshape(-1, nCells)
+            return np.stack([self.max(values) for values in flat]).reshape(block.shape[:-2] + (self.nZones,))
+
+        return data.map_blocks(blockMax,
+                               drop_axis=[data.ndim - 2, data.ndim - 1],
+                               new_axis=data.ndim - 2,
+                               chunks=data.chunks[:-2] + ((self.nZones,),),
+                               dtype=np.result_type(data.dtype, np.float32)).compute()
+
+    def window(self, transform, shape):
+        """Window of the label grid covered by a raster on the same grid (e.g. cropped from it)"""
+        col, row = ~self.transform * (transform.c, transform.f)
+        return rasterio.windows.Window(int(round(col)), int(round(row)), shape[1], shape[0])
+
+    def sum(self, values, window=None):
+        """Sum of values per zone, values covering the whole grid or only the given window of it"""
+        labels = self.labels if window is None else self.labels[window.toslices()]
+        weights = np.asarray(values, dtype=np.float64).ravel()
+        return np.bincount(labels.ravel(), weights=weights, minlength=self.nZones + 1)[1:]
+
+
+class StreamingZonalSums:
+
+    """
+    Sums and cell counts per admin area accumulated window by window, for rasters that
+    do not fit in memory. Only the admin areas intersecting a window are rasterized,
+    onto the grid of that window.
+    """
+
+    def __init__(self, admin_gdf):
+        codes, placeCodes = pd.factorize(admin_gdf['placeCode'])
+        self.placeCodes = list(placeCodes)
+        self.nZones = len(self.placeCodes)
+        self.geometries = admin_gdf.geometry.reset_index(drop=True)
+        self.labels = codes + 1
+        self.sums = np.zeros(self.nZones + 1, dtype=np.float64)
+        self.counts = np.zeros(self.nZones + 1, dtype=np.int64)
+
+    def add(self, values, valid, transform):
+        """Add the valid cells of a window of values with the given transform"""
+        bounds = rasterio.transform.array_bounds(values.shape[0], values.shape[1], transform)
+        # keep the order of the admin areas, so overlaps are labelled as on the full grid
+        areas = np.sort(self.geometries.sindex.query(box(*bounds)))
+        if len(areas) == 0:
+            return
+        labels = rasterio.features.rasterize(
+            ((self.geometries[i], self.labels[i]) for i in areas if self.geometries[i] is not None),
+            out_shape=values.shape,
+            transform=transform,
+            fill=0,
+            dtype='uint16' if self.nZones < np.iinfo(np.uint16).max else 'int32')[valid]
+        self.sums += np.bincount(labels, weights=values[valid].astype(np.float64), minlength=self.nZones + 1)
+        self.counts += np.bincount(labels, minlength=self.nZones + 1)
+
+    def result(self):
+        """Sums and cell counts per placeCode"""
+        return pd.Series(self.sums[1:], index=self.placeCodes), pd.Series(self.counts[1:], index=self.placeCodes)
+
+
+def blockWindows(dataset, window, size=RASTER_WINDOW_SIZE):
+    """
+    Windows of about size x size cells covering window, aligned to the internal blocks of
+    the dataset (whole rows of a striped raster, whole tiles of a tiled raster)
+    """
+    blockHeight, blockWidth = dataset.block_shapes[0]
+    height = max(blockHeight, size // blockHeight * blockHeight)
+    width = max(blockWidth, size // blockWidth * blockWidth)
+    for rowOff in range(window.row_off // height * height, window.row_off + window.height, height):
+        for colOff in range(window.col_off // width * width, window.col_off + window.width, width):
+            yield rasterio.windows.Window(colOff, rowOff, width, height).intersection(window)
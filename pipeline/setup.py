@@ -29,6 +29,7 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             f"run-flood-model = {PROJECT_NAME}.runPipeline:main",
+            f"replay-flood-uploads = {PROJECT_NAME}.replayUploads:main",
         ]
     }
 )
@@ -0,0 +1,140 @@
+"""
+Exposure of the triggered admin areas on a small synthetic population raster and flood extent.
+Run from the pipeline folder with:  python -m pytest tests
+"""
+import os
+import sys
+import json
+import types
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+from collections import OrderedDict
+
+os.environ.setdefault('COUNTRY_CODES_LIST', '["ZMB"]')
+os.environ.setdefault('ADMIN_LOGIN', 'pipeline@example.org')
+os.environ.setdefault('IBF_PASSWORD', 'password')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import numpy as np
+import pandas as pd
+import geopandas
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from flood_model.settings import *
+from flood_model import exposure
+from flood_model.exposure import Exposure
+from flood_model.rasterCache import RasterCache
+from flood_model.resultBus import ResultBus
+
+
+class ExposureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        for folder in [RASTER_INPUT + 'population', RASTER_OUTPUT + '0/flood_extents', RASTER_OUTPUT + '0/population',
+                       PIPELINE_OUTPUT + 'triggers_rp_per_station', PIPELINE_OUTPUT + 'calculated_affected']:
+            os.makedirs(folder)
+        patches = [mock.patch.object(exposure, 'RASTER_WINDOW_SIZE', 64),
+                   mock.patch.object(RasterCache, 'datasets', OrderedDict()),
+                   mock.patch.dict(ResultBus.results)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # population of 1 per cell on a 0.01 degree grid, with some nodata cells
+        transform = from_origin(30, 10, 0.01, 0.01)
+        meta = {'driver': 'GTiff', 'height': 200, 'width': 300, 'count': 1, 'crs': 'EPSG:4326',
+                'transform': transform, 'dtype': 'float32', 'nodata': -9999}
+        population = np.ones((200, 300), dtype='float32')
+        population[:, 100] = -9999
+        self.inputRaster = RASTER_INPUT + 'population/hrsl_zmb_pop_resized_100.tif'
+        with rasterio.open(self.inputRaster, 'w', **meta) as dest:
+            dest.write(population, 1)
+        # flood extent over the cells of rows 20-119 and columns 50-249
+        extent = np.full((200, 300), -1, dtype='float32')
+        extent[20:120, 50:250] = 1
+        with rasterio.open(RASTER_OUTPUT + '0/flood_extents/flood_extent_7-day_ZMB.tif', 'w', **dict(meta, nodata=-1)) as dest:
+            dest.write(extent, 1)
+
+        # three admin areas of 100 columns side by side, the station of ZMB02 is not triggered
+        self.placeCodes = ['ZMB00', 'ZMB01', 'ZMB02']
+        self.adminAreas = geopandas.GeoDataFrame(
+            {'placeCode': self.placeCodes},
+            geometry=[box(30 + i, 8, 31 + i, 10) for i in range(3)], crs='EPSG:4326')
+        self.districtMapping = [{'placeCode': placeCode, 'glofasStation': f'G{i}'}
+                                for i, placeCode in enumerate(self.placeCodes)]
+        self.writeTriggers({'G0': 1, 'G1': 1, 'G2': 0})
+
+    def tearDown(self):
+        for dataset in RasterCache.datasets.values():
+            dataset.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def writeTriggers(self, triggers):
+        with open(PIPELINE_OUTPUT + 'triggers_rp_per_station/triggers_rp_7-day_ZMB.json', 'w') as fp:
+            json.dump([{'stationCode': station, 'fc_trigger': trigger} for station, trigger in triggers.items()], fp)
+
+    def exposure(self):
+        calc = Exposure('7-day', 'ZMB', self.adminAreas, None, 3, self.districtMapping,
+                        pd.DataFrame({'placeCode_3': self.placeCodes}))
+        calc.inputRaster = self.inputRaster
+        calc.outputRaster = RASTER_OUTPUT + '0/population/hrsl_zmb_pop_resized_100_7-day.tif'
+        return calc
+
+    def calcAffected(self):
+        calc = self.exposure()
+        return {x['placeCode']: x['amount'] for x in calc.calcAffected(calc.disasterExtentRaster, 'population', 1)}
+
+    def test_affected_population_of_triggered_areas(self):
+        # 100 rows of 50 columns in ZMB00, of 99 columns in ZMB01 (one nodata column), none in ZMB02
+        self.assertEqual(self.calcAffected(), {'ZMB00': 5000.0, 'ZMB01': 9900.0, 'ZMB02': 0})
+
+    def test_affected_raster_covers_the_disaster_extent(self):
+        self.calcAffected()
+        with rasterio.open(RASTER_OUTPUT + '0/population/hrsl_zmb_pop_resized_100_7-day.tif') as src:
+            # within a cell of the extent, also over ZMB02, which is not triggered
+            np.testing.assert_allclose(src.bounds, (30.5, 8.8, 32.5, 9.8), atol=0.0101)
+            self.assertEqual(src.read(1, masked=True).sum(), 19900)
+
+    def test_affected_raster_is_all_zero_without_triggers(self):
+        self.writeTriggers({'G0': 0, 'G1': 0, 'G2': 0})
+        with rasterio.open(RASTER_OUTPUT + '0/flood_extents/flood_extent_7-day_ZMB.tif', 'r+') as dest:
+            dest.write(np.full((200, 300), -1, dtype='float32'), 1)
+        self.assertEqual(self.calcAffected(), {'ZMB00': 0, 'ZMB01': 0, 'ZMB02': 0})
+        with rasterio.open(RASTER_OUTPUT + '0/population/hrsl_zmb_pop_resized_100_7-day.tif') as src:
+            np.testing.assert_allclose(src.bounds, (30, 8, 33, 10), atol=0.0101)
+            self.assertFalse(src.read(1).any())
+
+    def test_streaming_gives_the_same_exposure(self):
+        expected = self.calcAffected()
+        os.remove(RASTER_OUTPUT + '0/population/hrsl_zmb_pop_resized_100_7-day.tif')
+        with mock.patch.dict(SETTINGS['ZMB'], {'EXPOSURE_STREAMING': True}):
+            self.assertEqual(self.calcAffected(), expected)
+
+    def test_streaming_without_reset_peak(self):
+        # tracemalloc of python 3.8, which has no reset_peak
+        tracemalloc38 = types.SimpleNamespace(**{name: getattr(tracemalloc, name) for name in
+                                                 ['start', 'stop', 'is_tracing', 'get_traced_memory']})
+        with mock.patch.dict(SETTINGS['ZMB'], {'EXPOSURE_STREAMING': True}), \
+                mock.patch.object(exposure, 'tracemalloc', tracemalloc38):
+            self.assertEqual(self.calcAffected(), {'ZMB00': 5000.0, 'ZMB01': 9900.0, 'ZMB02': 0})
+            # while the allocations are already traced
+            tracemalloc.start()
+            try:
+                self.assertEqual(self.calcAffected(), {'ZMB00': 5000.0, 'ZMB01': 9900.0, 'ZMB02': 0})
+                self.assertTrue(tracemalloc.is_tracing())
+            finally:
+                tracemalloc.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+Return period of the forecast and of the flood extent map per station.
+Run from the pipeline folder with:  python -m pytest tests
+"""
+import os
+import sys
+import json
+import unittest
+from unittest import mock
+
+os.environ.setdefault('COUNTRY_CODES_LIST', '["ZMB"]')
+os.environ.setdefault('ADMIN_LOGIN', 'pipeline@example.org')
+os.environ.setdefault('IBF_PASSWORD', 'password')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import pandas as pd
+
+from flood_model.settings import *
+from flood_model.returnPeriods import classifyReturnPeriods
+
+
+class ReturnPeriodsTest(unittest.TestCase):
+
+    def stations(self):
+        return pd.DataFrame({
+            'stationCode': ['G1', 'G2', 'G3', 'G4'],
+            'fc': [250.0, 150.0, 50.0, 250.0],
+            'fc_trigger': [1, 1, 1, 0],
+            'threshold2Year': [60.0] * 4,
+            'threshold5Year': [80.0] * 4,
+            'threshold10Year': [100.0] * 4,
+            'threshold20Year': [200.0] * 4})
+
+    def test_zmb_maps_of_10_and_20_years(self):
+        df = classifyReturnPeriods(self.stations(), 'ZMB')
+        self.assertEqual(json.loads(df[['fc_rp', 'fc_rp_flood_extent']].to_json(orient='records')), [
+            {'fc_rp': 20, 'fc_rp_flood_extent': 20},
+            {'fc_rp': 10, 'fc_rp_flood_extent': 10},
+            {'fc_rp': None, 'fc_rp_flood_extent': 10},
+            {'fc_rp': 20, 'fc_rp_flood_extent': None}])
+
+    def test_default_map_of_25_years(self):
+        with mock.patch.dict(SETTINGS, {'UGA': {}}):
+            df = classifyReturnPeriods(self.stations(), 'UGA')
+        self.assertEqual(list(df['fc_rp_flood_extent']), [25, 25, 25, pd.NA])
+
+    def test_return_periods_are_integers_in_the_json(self):
+        out = classifyReturnPeriods(self.stations(), 'ZMB').to_json(orient='records')
+        self.assertIn('"fc_rp_flood_extent":20,"fc_rp":20}', out)
+        self.assertIn('"fc_rp_flood_extent":10,"fc_rp":null}', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+"""
+Upload spool and replay against a local stand-in of the IBF API.
+Run from the pipeline folder with:  python -m pytest tests
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+os.environ.setdefault('COUNTRY_CODES_LIST', '["ZMB"]')
+os.environ.setdefault('ADMIN_LOGIN', 'pipeline@example.org')
+os.environ.setdefault('IBF_PASSWORD', 'password')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from flood_model.settings import *
+from flood_model import dynamicDataDb
+from flood_model.dynamicDataDb import DatabaseManager
+from flood_model.multipartStream import MultipartStream
+from flood_model.uploadSpool import UploadSpool
+from flood_model import replayUploads
+
+
+class ApiStandIn(BaseHTTPRequestHandler):
+
+    """IBF API stand-in: logs in with numbered tokens, and answers posts with the status set per path"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'{}'):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        api = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = self.path[len('/api/'):]
+        with api.lock:
+            if path == 'user/login':
+                api.logins += 1
+                return self.reply(200, json.dumps({'user': {'token': f'token-{api.logins}'}}).encode())
+            if self.headers.get('Authorization') in ['Bearer ' + token for token in api.expiredTokens]:
+                return self.reply(401)
+            status = api.status.get(path, 201)
+            if status < 400:
+                api.posts.append((path, body))
+        self.reply(status)
+
+
+class UploadSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = ThreadingHTTPServer(('127.0.0.1', 0), ApiStandIn)
+        self.api.lock = threading.Lock()
+        self.api.logins = 0
+        self.api.expiredTokens = []
+        self.api.status = {}
+        self.api.posts = []
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.api.server_address[1]}/api/'
+
+        # the spool and outputs are relative to the folder the pipeline runs in
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        patches = [mock.patch.dict(SETTINGS['ZMB'], {'IBF_API_URL': url, 'PASSWORD': 'password',
+                                                      'lead_times': {'3-day': 3, '7-day': 7}}),
+                   mock.patch.object(dynamicDataDb, 'API_UPLOAD_BACKOFF', 0),
+                   mock.patch.dict(UploadSpool.runs)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.api.shutdown()
+        self.api.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def newRun(self):
+        """Start the next run of the pipeline: uploads of the previous run are pending now"""
+        UploadSpool.runs.clear()
+
+    def uploadExposure(self, db, indicator, run=1):
+        return db.apiPostRequest('admin-area-dynamic-data/exposure', retries=API_UPLOAD_RETRIES,
+                                 body={'dynamicIndicator': indicator, 'adminLevel': 3, 'run': run})
+
+    def postedIndicators(self):
+        return [json.loads(body)['dynamicIndicator'] for path, body in self.api.posts
+                if path == 'admin-area-dynamic-data/exposure']
+
+    def test_failed_uploads_are_spooled_and_replayed_in_order(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['admin-area-dynamic-data/exposure'] = 503
+        self.assertFalse(self.uploadExposure(db, 'population'))
+        self.assertFalse(self.uploadExposure(db, 'alert_threshold'))
+        with open('flood_extent.tif', 'wb') as fp:
+            fp.write(b'extent' * 1000)
+        # waits for the failed uploads before it
+        with MultipartStream('file', 'flood_extent.tif') as stream:
+            self.assertFalse(db.apiPostRequest('admin-area-dynamic-data/raster/floods', stream=stream))
+        self.assertEqual(UploadSpool().count(), 3)
+        self.assertEqual(self.api.posts, [])
+
+        # the next run overwrites the outputs, the API is reachable again
+        self.newRun()
+        with open('flood_extent.tif', 'wb') as fp:
+            fp.write(b'other')
+        del self.api.status['admin-area-dynamic-data/exposure']
+        result = DatabaseManager.replayUploads()
+        self.assertEqual(result, {'replayed': 3, 'pending': 0})
+        self.assertEqual(self.postedIndicators(), ['population', 'alert_threshold'])
+        self.assertEqual(self.api.posts[-1][0], 'admin-area-dynamic-data/raster/floods')
+        self.assertIn(b'extent' * 1000, self.api.posts[-1][1])
+        self.assertEqual(os.listdir(UPLOAD_SPOOL), ['uploads.sqlite'])
+
+    def test_spooled_file_is_replayed_from_the_spool(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        with open('flood_extent.tif', 'wb') as fp:
+            fp.write(b'extent' * 1000)
+        self.api.status['admin-area-dynamic-data/raster/floods'] = 503
+        with MultipartStream('file', 'flood_extent.tif') as stream:
+            self.assertFalse(db.apiPostRequest('admin-area-dynamic-data/raster/floods', stream=stream))
+        with open('flood_extent.tif', 'wb') as fp:
+            fp.write(b'other')
+
+        self.newRun()
+        del self.api.status['admin-area-dynamic-data/raster/floods']
+        self.assertEqual(DatabaseManager.replayUploads(), {'replayed': 1, 'pending': 0})
+        self.assertIn(b'extent' * 1000, self.api.posts[0][1])
+
+    def test_uploads_after_a_failure_in_the_run_wait_for_it(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['admin-area-dynamic-data/exposure'] = 503
+        self.assertFalse(self.uploadExposure(db, 'population'))
+        del self.api.status['admin-area-dynamic-data/exposure']
+        self.assertFalse(self.uploadExposure(db, 'alert_threshold'))
+        # other lead times are not held up
+        self.assertTrue(self.uploadExposure(DatabaseManager('3-day', 'ZMB', 3), 'population'))
+        self.assertEqual(UploadSpool().count(), 2)
+        self.assertEqual(len(self.api.posts), 1)
+
+    def test_new_run_replaces_pending_uploads_of_the_same_data(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['admin-area-dynamic-data/exposure'] = 503
+        self.uploadExposure(db, 'population', run=1)
+        self.uploadExposure(db, 'alert_threshold', run=1)
+
+        # pending uploads of an earlier run do not block the new run, they are replaced
+        self.newRun()
+        del self.api.status['admin-area-dynamic-data/exposure']
+        self.assertTrue(self.uploadExposure(db, 'population', run=2))
+        self.assertEqual(UploadSpool().count(), 1)
+        self.assertEqual(DatabaseManager.replayUploads(), {'replayed': 1, 'pending': 0})
+        self.assertEqual([json.loads(body)['run'] for path, body in self.api.posts], [2, 1])
+
+    def test_failing_upload_is_dead_after_the_last_attempt(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['event/triggers-per-leadtime'] = 503
+        db.apiPostRequest('event/triggers-per-leadtime', body={})
+        for attempt in range(UPLOAD_SPOOL_MAX_ATTEMPTS - 1):
+            self.newRun()
+            self.assertEqual(DatabaseManager.replayUploads()['replayed'], 0)
+        self.assertEqual(UploadSpool().count(), 0)
+        with UploadSpool().connect() as spool:
+            self.assertEqual([tuple(row) for row in spool.execute('SELECT status, attempts FROM uploads')],
+                             [('dead', UPLOAD_SPOOL_MAX_ATTEMPTS)])
+
+    def test_rejected_upload_is_kept_but_not_replayed(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['glofas-stations/triggers'] = 400
+        self.assertFalse(db.apiPostRequest('glofas-stations/triggers', body={}))
+        # a rejected upload does not block the uploads after it
+        self.assertTrue(self.uploadExposure(db, 'population'))
+        self.assertEqual(UploadSpool().count(), 0)
+
+        self.newRun()
+        del self.api.status['glofas-stations/triggers']
+        self.assertEqual(DatabaseManager.replayUploads(), {'replayed': 0, 'pending': 0})
+        with UploadSpool().connect() as spool:
+            self.assertEqual([tuple(row) for row in spool.execute('SELECT path, status FROM uploads')],
+                             [('glofas-stations/triggers', 'rejected')])
+
+    def test_expired_token_is_renewed(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.expiredTokens = ['token-1']
+        self.assertTrue(self.uploadExposure(db, 'population'))
+        self.assertEqual(self.api.logins, 2)
+        self.assertEqual(UploadSpool().count(), 0)
+
+    def test_notification_is_not_spooled(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['admin-area-dynamic-data/exposure'] = 503
+        self.uploadExposure(db, 'population')
+        db.sendNotification()
+        self.assertEqual(self.api.posts, [])
+
+        self.newRun()
+        self.api.status['notification/send'] = 503
+        with self.assertRaises(ValueError):
+            db.sendNotification()
+        self.assertEqual(UploadSpool().count(), 1)
+
+    def test_replay_command_exit_code(self):
+        db = DatabaseManager('7-day', 'ZMB', 3)
+        self.api.status['admin-area-dynamic-data/exposure'] = 503
+        self.uploadExposure(db, 'population')
+        self.newRun()
+        with mock.patch.object(sys, 'argv', ['replay-flood-uploads', 'ZMB']):
+            with self.assertRaises(SystemExit) as exit:
+                replayUploads.main()
+            self.assertEqual(exit.exception.code, 1)
+
+            del self.api.status['admin-area-dynamic-data/exposure']
+            with self.assertRaises(SystemExit) as exit:
+                replayUploads.main()
+            self.assertEqual(exit.exception.code, 0)
+        self.assertEqual(self.postedIndicators(), ['population'])
+
+
+if __name__ == '__main__':
+    unittest.main()